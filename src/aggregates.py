@@ -0,0 +1,97 @@
+import pandas as pd
+
+from history_store import (
+    load_streaming_history,
+    store_dir,
+    store_version,
+    write_parquet,
+)
+from listening import build_listening_frame
+from time_cube import TimeCube
+
+
+class Aggregates:
+    """Persisted aggregates of the streaming history.
+
+    The time cube behind the heatmaps plus plays and ms played per artist
+    and per (artist, track). They are saved in the history store and kept
+    up to date by add() when plays are appended, instead of being
+    recomputed from the whole history.
+    """
+
+    def __init__(self, cube, artists, tracks):
+        self.cube = cube
+        self.artists = artists
+        self.tracks = tracks
+
+    @classmethod
+    def from_frame(cls, frame):
+        return cls(
+            TimeCube.from_frame(frame),
+            totals(frame, ["artistName"]),
+            totals(frame, ["artistName", "trackName"]),
+        )
+
+    def add(self, frame):
+        """Adds the plays of a listening frame in place"""
+        self.cube.add(frame)
+        self.artists = add_totals(self.artists, totals(frame, ["artistName"]))
+        self.tracks = add_totals(
+            self.tracks, totals(frame, ["artistName", "trackName"])
+        )
+
+    def save(self, csv_path, version):
+        directory = store_dir(csv_path)
+        self.cube.save(directory / "cube.npz", version)
+        for name, df in [("artists", self.artists), ("tracks", self.tracks)]:
+            df = df.reset_index().assign(version=version)
+            write_parquet(df, directory / f"{name}_totals.parquet")
+
+    @classmethod
+    def load(cls, csv_path, version):
+        """The saved aggregates, or None if missing or not at version"""
+        directory = store_dir(csv_path)
+        cube = TimeCube.load(directory / "cube.npz", version)
+        if cube is None:
+            return None
+        loaded = []
+        for name, keys in [
+            ("artists", ["artistName"]),
+            ("tracks", ["artistName", "trackName"]),
+        ]:
+            try:
+                df = pd.read_parquet(directory / f"{name}_totals.parquet")
+            except OSError:
+                return None
+            if not (df["version"] == version).all():
+                return None
+            loaded.append(df.drop(columns="version").set_index(keys))
+        return cls(cube, *loaded)
+
+
+def totals(frame, keys):
+    # Plain string keys so totals of different frames align on add()
+    df = frame[[*keys, "msPlayed"]].astype({key: "string" for key in keys})
+    df = df.groupby(keys)["msPlayed"].agg(["size", "sum"])
+    df.columns = ["plays", "msPlayed"]
+    return df.astype("int64")
+
+
+def add_totals(df, other):
+    return df.add(other, fill_value=0).astype("int64")
+
+
+def load_aggregates(csv_path, frame=None):
+    """Saved aggregates of the store, rebuilt when stale.
+
+    frame is the listening frame of the current history, if the caller
+    already has it; otherwise it is built from the store when needed.
+    """
+    version = store_version(csv_path)
+    aggregates = Aggregates.load(csv_path, version)
+    if aggregates is None:
+        if frame is None:
+            frame, _ = build_listening_frame(load_streaming_history(csv_path))
+        aggregates = Aggregates.from_frame(frame)
+        aggregates.save(csv_path, version)
+    return aggregates
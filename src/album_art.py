@@ -0,0 +1,105 @@
+import os
+import re
+import tempfile
+import threading
+from io import BytesIO
+
+import requests
+from flask import Blueprint, abort, redirect, request as flask_request, \
+    send_file
+
+from spotify_client import request
+
+try:
+    from PIL import Image
+except ImportError:
+    # Without Pillow the cards link to Spotify's CDN, see album_art_url()
+    Image = None
+
+image_host = "https://i.scdn.co/image/"
+# Shared by the gunicorn workers of the app
+default_cache_directory = os.environ.get(
+    "SPOTIFY_ALBUM_ART_CACHE",
+    os.path.join(tempfile.gettempdir(), "spotify_analyzer_album_art"),
+)
+# Pixel widths the cards ask for, about twice their CSS size for HiDPI
+# screens. Only these are served so the cache cannot grow without bound.
+recent_track_size = 96
+top_track_size = 200
+sizes = (recent_track_size, top_track_size)
+# Album art never changes for a given image id
+max_age = 365 * 24 * 3600
+
+image_id_pattern = re.compile(r"[0-9a-f]{40}")
+
+album_art = Blueprint("album_art", __name__)
+
+
+def smallest_image(images, width):
+    """Smallest of Spotify's images at least width pixels wide.
+
+    Falls back to the largest one when none is wide enough.
+    """
+    images = sorted(images, key=lambda image: image.get("width") or 0)
+    for image in images:
+        if (image.get("width") or 0) >= width:
+            return image
+    return images[-1]
+
+
+def album_art_url(images, width):
+    """URL of a card's album art, proxied through the app when possible.
+
+    Without Pillow the proxy could not make the images any smaller, so the
+    CDN serves them directly.
+    """
+    url = smallest_image(images, width)["url"]
+    if Image is not None and width in sizes and url.startswith(image_host):
+        image_id = url[len(image_host):]
+        if image_id_pattern.fullmatch(image_id):
+            return f"/album-art/{image_id}?size={width}"
+    return url
+
+
+def cached_image(image_id, size, directory=default_cache_directory):
+    """Path of the image resized to size, downloaded on first use"""
+    path = os.path.join(directory, f"{image_id}-{size}.jpg")
+    if os.path.exists(path):
+        return path
+    response = request("GET", image_host + image_id)
+    response.raise_for_status()
+    content = response.content
+    if Image is not None:
+        image = Image.open(BytesIO(content))
+        if image.width > size:
+            image.thumbnail((size, size))
+            output = BytesIO()
+            image.convert("RGB").save(
+                output, "JPEG", quality=85, optimize=True, progressive=True
+            )
+            content = output.getvalue()
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    return path
+
+
+@album_art.route("/album-art/<image_id>")
+def serve_album_art(image_id):
+    # Only ids of Spotify's CDN, never arbitrary paths or URLs
+    if not image_id_pattern.fullmatch(image_id):
+        abort(404)
+    size = flask_request.args.get("size", type=int)
+    if size not in sizes:
+        abort(400)
+    try:
+        path = cached_image(image_id, size)
+    except (requests.RequestException, OSError, ValueError) as error:
+        print(f"Album art {image_id} unavailable: {error}")
+        return redirect(image_host + image_id)
+    response = send_file(path, mimetype="image/jpeg", max_age=max_age)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
@@ -1,16 +1,40 @@
+import time
+
+# Startup phases are timed from here, see startup_timer below
+import_started = time.perf_counter()
+
 import inspect
 import os.path
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from refresh import Refresh
-import requests
+from refresh import access_token
+from aggregates import load_aggregates
+from album_art import album_art, album_art_url, recent_track_size, \
+    top_track_size
+from figure_cache import FigureCache, size_bucket
+from history_store import load_streaming_history, saved_store_version, \
+    store_lock, store_version
+from listening import build_listening_frame, date_window, memory_report
+from time_cube import day_hour_cells, encode_cells
+from rankings import TopK
+from recently_played import RecentlyPlayedPoller
+from response_cache import ResponseCache
+from spotify_client import SpotifyClient, SpotifyUnavailable
+from startup import StartupTimer
 
 from dash import Dash, html, dcc, Output, Input, callback, \
     clientside_callback
 from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objs as go
+from flask import jsonify
+
+startup_timer = StartupTimer(import_started)
+startup_timer.mark("imports")
 
 # Initialize App
 dbc_css = (
@@ -28,6 +52,8 @@ app = Dash(
     ],
 )
 server = app.server
+# Resized, long-cached album art for the track cards
+server.register_blueprint(album_art)
 app.title = "Spotify Analyzer"
 landing_urls = [
     "http://127.0.0.1:8050/",
@@ -41,59 +67,166 @@ filename = inspect.getframeinfo(inspect.currentframe()).filename
 current_directory = os.path.dirname(os.path.abspath(filename))
 current_directory = current_directory.replace("\\", "/")
 spotify_data_path = Path(current_directory + "/streaming_history.csv")
-spotify_df = pd.read_csv(spotify_data_path)
+# Set COMPACT_HISTORY=0 to keep plain strings and int64s in the frames
+compact_history = os.environ.get("COMPACT_HISTORY", "1") != "0"
+# The data is loaded and Spotify warmed up in the background after the
+# worker boots. Set LAZY_STARTUP=0 to do it before the app is served.
+lazy_startup = os.environ.get("LAZY_STARTUP", "1") != "0"
+# Seconds between polls of recently played, which append new plays to the
+# history. 0 (the default) leaves the history as it is.
+recently_played_interval = float(
+    os.environ.get("RECENTLY_PLAYED_INTERVAL", "0")
+)
+# Set CLIENTSIDE_HEATMAPS=1 to send every week's counts to the browser
+# once and switch weeks and layouts of the weekly heatmap there
+clientside_heatmaps = os.environ.get("CLIENTSIDE_HEATMAPS", "0") == "1"
+# How often a worker checks whether the history store changed
+reload_check_interval = 60
+
+
+class ListeningData:
+    """Shared, read-only frames and aggregates behind the charts.
+
+    The listening frame has the derived hour/day/week columns, tracks has
+    one row per track. The raw frame is not kept around so each worker
+    only holds one copy.
+    """
+
+    def __init__(self, csv_path, compact=True, timer=None):
+        timer = timer or StartupTimer()
+        # One hold of the store lock, so plays appended meanwhile cannot
+        # end up in the aggregates or the version but not in the frames
+        with store_lock(csv_path):
+            with timer.phase("history"):
+                history = load_streaming_history(csv_path)
+            with timer.phase("listening frame"):
+                self.listening_df, self.tracks_df = build_listening_frame(
+                    history, compact=compact
+                )
+            # Play counts per (year, week, day, hour) behind the heatmaps
+            # and stats plus per artist and track totals, persisted in the
+            # history store and updated by ingest.py
+            with timer.phase("aggregates"):
+                aggregates = load_aggregates(csv_path, self.listening_df)
+            self.version = store_version(csv_path)
+        print(memory_report(self.listening_df, self.tracks_df))
+        self.time_cube = aggregates.cube
+        # Dense (weeks, 7, 24) counts of every (ISO year, ISO week) played
+        self.weekly_keys, self.weekly_cells = self.time_cube.weekly()
+        self.weekly_positions = {
+            week_value(key): i for i, key in enumerate(self.weekly_keys)
+        }
+        # Memoized top artists/tracks rankings, the whole-history ones
+        # from the persisted totals
+        self.top_k = TopK(self.listening_df, self.tracks_df, aggregates)
+        self.checked = time.monotonic()
+
+
+listening_data_lock = threading.Lock()
+loaded_listening_data = None
+
+
+def listening_data():
+    """The ListeningData of the app, loaded by whoever needs it first.
+
+    It is reloaded when the history store changed, e.g. after plays were
+    appended by the recently played poller or ingest.py.
+    """
+    global loaded_listening_data
+    data = loaded_listening_data
+    if (
+        data is not None
+        and time.monotonic() - data.checked < reload_check_interval
+    ):
+        return data
+    with listening_data_lock:
+        data = loaded_listening_data
+        if data is None:
+            loaded_listening_data = ListeningData(
+                spotify_data_path, compact_history, startup_timer
+            )
+        elif time.monotonic() - data.checked >= reload_check_interval:
+            data.checked = time.monotonic()
+            # Not store_version(), which would wait for a running ingest
+            version = saved_store_version(spotify_data_path)
+            if version not in (None, data.version):
+                loaded_listening_data = ListeningData(
+                    spotify_data_path, compact_history
+                )
+    return loaded_listening_data
+
+
+# Heatmaps and bar charts by data version, week or date range, orientation
+# and size, so resizing or going back to a week does not rebuild them
+figure_cache = FigureCache()
+
+
+@server.route("/metrics/figure-cache")
+def figure_cache_metrics():
+    return jsonify(figure_cache.stats())
+
+
+# Pooled, retrying Web API client behind a response cache shared by the
+# workers, so switching top tracks ranges does not wait for Spotify
+spotify_api = SpotifyClient(access_token)
+spotify = ResponseCache(spotify_api)
 
 
 class GetTopStats:
     def __init__(self):
-        self.spotify_token = ""
         self.top_tracks = {}
         self.recent_tracks = {}
 
     def get_top_tracks(self, time_range, limit=12):
-        url = (
-            f"https://api.spotify.com/v1/me/top/tracks?"
-            f"time_range={time_range}&limit={limit}"
+        self.top_tracks = spotify.get(
+            "me/top/tracks", {"time_range": time_range, "limit": limit}
         )
 
-        response = requests.get(
-            url,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.spotify_token}",
-            },
+    def get_recently_played(self, limit=7):
+        self.recent_tracks = spotify.get(
+            "me/player/recently-played", {"limit": limit}
         )
 
-        if not response.text:
-            print('Response is empty')
 
-        self.top_tracks = response.json()
+track_ranges = {
+    "Last 4 Weeks": "short_term",
+    "Last 6 Months": "medium_term",
+    "All Time": "long_term",
+}
+# Fetches the Spotify panels of the overview page side by side
+prefetch_pool = ThreadPoolExecutor(max_workers=1 + len(track_ranges))
 
-    def get_recently_played(self, limit=7):
-        url = (
-            "https://api.spotify.com/v1/me/player/recently-played?"
-            f"limit={limit}"
-        )
-
-        response = requests.get(
-            url,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.spotify_token}",
-            },
-        )
 
-        self.recent_tracks = response.json()
+def prefetch_overview():
+    """Fills the response cache with every Spotify panel of the overview.
 
-    def call_refresh(self):
-        """Calls the refresh method from the Refresh class"""
-        refreshCaller = Refresh()
-        self.spotify_token = refreshCaller.refresh()
+    Recently played and the three top tracks ranges are fetched at the
+    same time, so the page waits for the slowest call instead of all of
+    them in a row, and switching ranges afterwards is served from cache.
+    """
+    top = GetTopStats()
+    futures = [prefetch_pool.submit(top.get_recently_played)] + [
+        prefetch_pool.submit(top.get_top_tracks, time_range)
+        for time_range in track_ranges.values()
+    ]
+    for future in futures:
+        try:
+            future.result()
+        except SpotifyUnavailable:
+            # The panel says so when it is rendered
+            pass
+
+
+def spotify_unavailable():
+    return html.P(
+        "Spotify is not responding right now, please try again later.",
+        className="section-header",
+    )
 
 
 def top_track_div(item):
     image = dbc.CardImg(
-        src=item["album"]["images"][0]["url"],
+        src=album_art_url(item["album"]["images"], top_track_size),
         top=True,
         className="image-top-track"
     )
@@ -121,7 +254,9 @@ def top_track_div(item):
 
 def recent_track_div(item):
     image = dbc.CardImg(
-        src=item["track"]["album"]["images"][0]["url"],
+        src=album_art_url(
+            item["track"]["album"]["images"], recent_track_size
+        ),
         top=True
     )
     track_name = item["track"]["name"]
@@ -154,14 +289,11 @@ def recent_track_div(item):
 
 
 def top_tracks(range):
-    dict_ranges = {
-        "Last 4 Weeks": "short_term",
-        "Last 6 Months": "medium_term",
-        "All Time": "long_term",
-    }
     top = GetTopStats()
-    top.call_refresh()
-    top.get_top_tracks(time_range=dict_ranges[range])
+    try:
+        top.get_top_tracks(time_range=track_ranges[range])
+    except SpotifyUnavailable:
+        return spotify_unavailable()
     items = [top_track_div(item) for item in top.top_tracks["items"]]
 
     container = html.Div(
@@ -183,8 +315,10 @@ def top_tracks(range):
 
 def recent_tracks():
     top = GetTopStats()
-    top.call_refresh()
-    top.get_recently_played()
+    try:
+        top.get_recently_played()
+    except SpotifyUnavailable:
+        return spotify_unavailable()
     results = top.recent_tracks
     title = html.H4(f"Top Tracks: {range}", className="section-header")
     items = [recent_track_div(item) for item in results["items"]]
@@ -198,16 +332,21 @@ def recent_tracks():
     return container
 
 
-def user_stats():
-    df = spotify_df.copy()
-    total_time = df["msPlayed"].sum()
+def user_stats(window=None):
+    data = listening_data()
+    if window is None:
+        total_time = data.time_cube.total_ms()
+        total_tracks = data.time_cube.total_plays()
+    else:
+        start, stop = window
+        ms_played = data.listening_df["msPlayed"].to_numpy()
+        total_time = int(ms_played[start:stop].sum())
+        total_tracks = stop - start
     total_time_minutes = round(total_time / 60000)
     total_time_hours = round(total_time / 3600000)
     total_time_days = round(total_time_hours / 24)
-    total_tracks = df.shape[0]
-    total_artists = df["artistName"].nunique()
-    df["trackLength"] = df["msPlayed"] / 60000
-    avg_track_length = round(df["trackLength"].mean(), 2)
+    total_artists = data.top_k.distinct("artist", window)
+    avg_track_length = round(total_time / max(total_tracks, 1) / 60000, 2)
 
     dict_stats = {
         "Minutes listened": total_time_minutes,
@@ -408,71 +547,50 @@ def df_to_heatmap_v(df):
     return fig
 
 
-def heatmap_yearly():
-    # Create a matrix dataframe with number of tracks played per hour (rows)
-    # and day of the week (columns)
-    df = spotify_df.copy()
-    df["endTime"] = pd.to_datetime(df["endTime"], format="%Y-%m-%d %H:%M")
-    df["hour"] = df["endTime"].dt.hour
-    df["day"] = df["endTime"].dt.dayofweek
-    heatmap = df.groupby(["day", "hour"]).count()
-    heatmap.reset_index(inplace=True)
-    heatmap = heatmap[["day", "hour", "trackName"]]
-    heatmap.rename(
-        columns={"trackName": "Number of songs listened"},
-        inplace=True
-    )
-    heatmap.sort_values(by=["day", "hour"], inplace=True)
-    heatmap.reset_index(inplace=True)
-    heatmap.drop(columns="index", inplace=True)
-    return heatmap
-
-
-def heatmap_weekly():
-    df = spotify_df.copy()
-    df["endTime"] = pd.to_datetime(df["endTime"], format="%Y-%m-%d %H:%M")
-    df["hour"] = df["endTime"].dt.hour
-    df["day"] = df["endTime"].dt.dayofweek
-    df["week"] = df["endTime"].dt.isocalendar().week
-    heatmap = df.groupby(["week", "day", "hour"]).count()
-    heatmap.reset_index(inplace=True)
-    heatmap = heatmap[["week", "day", "hour", "trackName"]]
-    heatmap.rename(
-        columns={"trackName": "Number of songs listened"},
-        inplace=True
-    )
-    heatmap.sort_values(by=["week", "day", "hour"], inplace=True)
-    heatmap.reset_index(inplace=True)
-    heatmap.drop(columns="index", inplace=True)
-    heatmap = heatmap.fillna(0)
-    # Create a list of dataframes, one for each week of the year
-    heatmap_list = [
-        heatmap[heatmap["week"] == week] for week in heatmap["week"].unique()
-    ]
-    # Create a list containing heatmap figures for each week of the year
-    json_list = [
-        df.to_json(date_format="iso", orient="split")
-        for df in heatmap_list
-    ]
-    return json_list
-
-
-def top_artists_bar_graph(window_width):
-    df = spotify_df.copy()
-    top_artists = df.groupby("artistName").sum()
-    top_artists.reset_index(inplace=True)
-    top_artists = top_artists[["artistName", "msPlayed"]]
-    top_artists["msPlayed"] = top_artists["msPlayed"] / 60000
-    top_artists["msPlayed"] = top_artists["msPlayed"].round()
-    top_artists.rename(columns={"msPlayed": "Minutes Listened"}, inplace=True)
-    top_artists.sort_values(
-        by="Minutes Listened",
-        ascending=False,
-        inplace=True
-    )
-    top_artists.reset_index(inplace=True)
-    top_artists.drop(columns="index", inplace=True)
-    top_artists = top_artists.head(15)
+def heatmap_yearly(window=None):
+    # 7x24 number of tracks played per day of the week (rows) and hour
+    # (columns), for the whole history or a row window
+    data = listening_data()
+    if window is None:
+        return data.time_cube.yearly()
+    return day_hour_cells(data.listening_df, window)
+
+
+def week_value(key):
+    # Dropdown value of a (year, week) key, like "2023-14"
+    year, week = key
+    return f"{year}-{week}"
+
+
+def heatmap_weekly(week):
+    # The 7x24 grid of a dropdown value, looked up on the server so the
+    # browser never holds more than the week it shows
+    data = listening_data()
+    position = data.weekly_positions.get(week)
+    if position is None:
+        return np.zeros(data.weekly_cells.shape[1:], dtype="int64")
+    return data.weekly_cells[position]
+
+
+def weekly_heatmap(cells, vertical, size=None):
+    # Rows are days and columns hours, transposed for the vertical layout.
+    # Without a size, the browser sets it (clientside heatmaps).
+    if vertical:
+        fig = df_to_heatmap_v(pd.DataFrame(cells.T))
+        if size is not None:
+            fig.update_layout(width=size)
+        fig.update_layout(yaxis=dict(tickfont=dict(size=8)))
+        fig.update_layout(xaxis=dict(tickfont=dict(size=8)))
+    else:
+        fig = df_to_heatmap_h(pd.DataFrame(cells))
+        if size is not None:
+            fig.update_layout(height=size)
+    return fig
+
+
+def top_artists_bar_graph(window_width, window=None):
+    top_k = listening_data().top_k
+    top_artists = top_k.top("artist", "minutes", window=window, n=15)
     colors = [
         "#b7193f",
         "#bc243f",
@@ -538,22 +656,9 @@ def top_artists_bar_graph(window_width):
     return fig
 
 
-def top_tracks_bar_graph(window_width):
-    df = spotify_df.copy()
-    top_tracks = df.groupby(["artistName", "trackName"]).sum()
-    top_tracks.reset_index(inplace=True)
-    top_tracks = top_tracks[["artistName", "trackName", "msPlayed"]]
-    top_tracks["msPlayed"] = top_tracks["msPlayed"] / 60000
-    top_tracks["msPlayed"] = top_tracks["msPlayed"].round()
-    top_tracks.rename(columns={"msPlayed": "Minutes Listened"}, inplace=True)
-    top_tracks.sort_values(
-        by="Minutes Listened",
-        ascending=False,
-        inplace=True
-    )
-    top_tracks.reset_index(inplace=True)
-    top_tracks.drop(columns="index", inplace=True)
-    top_tracks = top_tracks.head(15)
+def top_tracks_bar_graph(window_width, window=None):
+    top_k = listening_data().top_k
+    top_tracks = top_k.top("track", "minutes", window=window, n=15)
 
     # Create the graph with the artist with most listened minutes on top
     colors = [
@@ -650,6 +755,20 @@ def tracks_range_radio(id, value):
     )
 
 
+def date_range_picker(id):
+    dates = listening_data().listening_df["date"]
+    return dcc.DatePickerRange(
+        id=id,
+        min_date_allowed=dates.min().date(),
+        max_date_allowed=dates.max().date(),
+        start_date_placeholder_text="From",
+        end_date_placeholder_text="To",
+        display_format="YYYY-MM-DD",
+        clearable=True,
+        persistence=True,
+    )
+
+
 profile_image = html.Div(
     [
         html.A(
@@ -665,8 +784,6 @@ profile_image = html.Div(
     className="profile-image-container",
 )
 card_top_tracks = html.Div([], id="top-tracks")
-card_recent_tracks = html.Div([recent_tracks()], id="recent-tracks")
-card_user_stats = html.Div(user_stats())
 
 navbar = dbc.Nav(
     [
@@ -702,34 +819,72 @@ navbar = dbc.Nav(
 navbar_container = dbc.Col(
     [navbar], xs=12, lg=1, className="column-container", id="navbar-container"
 )
-dropdown_options = [{"label": f"Week {x}", "value": x} for x in range(0, 53)]
-dropdown_week = html.Div(
-    [
-        dcc.Dropdown(
-            options=dropdown_options,
-            value=0,
-            id="dropdown-week",
-            maxHeight=150
-        )
-    ]
-)
 control_title = html.H4("Select", className="section-header")
-navbar_container_dropdown = dbc.Col(
-    className="column-container",
-    xs=12,
-    lg=1,
-    children=[
-        html.Div([dbc.Col([navbar])]),
-        html.Div(
-            [
-                dbc.Col(
-                    [control_title, dropdown_week],
-                    className="controls"
-                )
-            ],
-        ),
-    ],
-)
+date_range_title = html.H4("Date range", className="section-header")
+
+
+# The controls below depend on the listening data, so they are built when
+# their page is requested rather than at import
+def dropdown_week():
+    weekly_keys = listening_data().weekly_keys
+    dropdown_options = [
+        {"label": f"Week {week}, {year}", "value": week_value((year, week))}
+        for year, week in weekly_keys
+    ]
+    return html.Div(
+        [
+            dcc.Dropdown(
+                options=dropdown_options,
+                value=week_value(weekly_keys[0]) if weekly_keys else None,
+                id="dropdown-week",
+                maxHeight=150
+            )
+        ]
+    )
+
+
+def navbar_container_dropdown():
+    return dbc.Col(
+        className="column-container",
+        xs=12,
+        lg=1,
+        children=[
+            html.Div([dbc.Col([navbar])]),
+            html.Div(
+                [
+                    dbc.Col(
+                        [
+                            control_title,
+                            dropdown_week(),
+                            date_range_title,
+                            date_range_picker("date-range"),
+                        ],
+                        className="controls"
+                    )
+                ],
+            ),
+        ],
+    )
+
+
+def navbar_container_date_range():
+    return dbc.Col(
+        className="column-container",
+        xs=12,
+        lg=1,
+        children=[
+            html.Div([dbc.Col([navbar])]),
+            html.Div(
+                [
+                    dbc.Col(
+                        [date_range_title, date_range_picker("date-range")],
+                        className="controls"
+                    )
+                ],
+            ),
+        ],
+    )
+
 
 content = dbc.Container(
     children=[
@@ -840,7 +995,6 @@ app.layout = dbc.Container(
         html.Div(id="dummy"),
         dcc.Location(id="url"),
         dcc.Store(id="stored-window-size"),
-        dcc.Store(id="stored-heatmap-yearly"),
         dcc.Store(id="stored-heatmap-weekly"),
         content,
     ],
@@ -914,22 +1068,30 @@ def show_profilepic_tooltip(url):
         return False
 
 
-@callback(
-    Output("stored-heatmap-yearly", "data"),
-    Input("dummy", "children"),
-)
-def store_heatmap_data_yearly_callback(dummy):
-    df = heatmap_yearly().to_json(date_format="iso", orient="split")
-    return df
-
-
 @callback(
     Output("stored-heatmap-weekly", "data"),
     Input("dummy", "children"),
 )
 def store_heatmap_data_weekly_callback(dummy):
-    df = heatmap_weekly()
-    return df
+    data = listening_data()
+    if not clientside_heatmaps:
+        # Only a handle, the weeks are served by listening_patterns_weekly
+        return {"version": data.version}
+    # Every week and a figure without counts per layout, sent once and
+    # filled in by the browser
+    empty = np.zeros(data.weekly_cells.shape[1:], dtype="uint32")
+    return {
+        "version": data.version,
+        "weeks": [week_value(key) for key in data.weekly_keys],
+        "counts": encode_cells(data.weekly_cells),
+        "figures": {
+            layout: figure_cache.get(
+                ("weekly skeleton", data.version, vertical),
+                lambda: weekly_heatmap(empty, vertical),
+            )
+            for layout, vertical in [("horizontal", False), ("vertical", True)]
+        },
+    }
 
 
 @callback(
@@ -973,104 +1135,214 @@ def top_tracks_children(window_size, value):
 @callback(
     Output("listening-patterns-yearly", "children"),
     Input("stored-window-size", "data"),
-    Input("stored-heatmap-yearly", "data"),
+    Input("date-range", "start_date"),
+    Input("date-range", "end_date"),
 )
-def listening_patterns_yearly_callback(window_size, heatmap_yearly_json):
-    title1 = html.H4(
-        'Yearly listening patterns',
-        className='section-header section-header-heatmap'
-    )
-    df = pd.read_json(heatmap_yearly_json, orient='split').copy()
-    height = window_size[0] * 0.35
-    width = window_size[1]
-
-    if width < 670:
-        df = df.pivot(
-            index='hour',
-            columns='day',
-            values='Number of songs listened'
+def listening_patterns_yearly_callback(
+    window_size, start_date, end_date
+):
+    data = listening_data()
+    window = date_window(data.listening_df, start_date, end_date)
+    if window is None:
+        title1 = html.H4(
+            'Yearly listening patterns',
+            className='section-header section-header-heatmap'
         )
-        fig = df_to_heatmap_v(df)
-        fig.update_layout(width=width)
     else:
-        df = df.pivot(
-            index='day',
-            columns='hour',
-            values='Number of songs listened'
+        title1 = html.H4(
+            f'Listening patterns ({start_date or "start"} - '
+            f'{end_date or "today"})',
+            className='section-header section-header-heatmap'
         )
-        fig = df_to_heatmap_h(df)
-        fig.update_layout(height=height)
-
-    if width < 670:
-        fig.update_layout(yaxis=dict(tickfont=dict(size=8)))
-        fig.update_layout(xaxis=dict(tickfont=dict(size=8)))
+    vertical = window_size[1] < 670
+    size = size_bucket(window_size[1] if vertical else window_size[0] * 0.35)
+
+    # Built from the server's data only, the figure is shared by everyone
+    def build():
+        cells = heatmap_yearly(window)
+        # Rows are days and columns hours, transposed for the vertical
+        # layout
+        if vertical:
+            fig = df_to_heatmap_v(pd.DataFrame(cells.T))
+            fig.update_layout(width=size)
+            fig.update_layout(yaxis=dict(tickfont=dict(size=8)))
+            fig.update_layout(xaxis=dict(tickfont=dict(size=8)))
+        else:
+            fig = df_to_heatmap_h(pd.DataFrame(cells))
+            fig.update_layout(height=size)
+        return fig
+
+    figure = figure_cache.get(
+        ("yearly", data.version, window, vertical, size), build
+    )
     listening_patterns_yearly = html.Div(
-        [dcc.Graph(figure=fig)],
+        [dcc.Graph(figure=figure)],
         className='heatmap'
     )
     return [title1, listening_patterns_yearly]
 
 
-@callback(
-    Output("listening-patterns-weekly", "children"),
-    Output("dropdown-week", "searchable"),
-    Input("stored-window-size", "data"),
-    Input("stored-heatmap-weekly", "data"),
-    Input("dropdown-week", "value"),
-)
-def listening_patterns_weekly_callback(window_size, heatmap_weekly_json, week):
+def listening_patterns_weekly_callback(window_size, weekly_handle, week):
+    if week is None:
+        raise PreventUpdate
+    year, week_number = week.split("-")
     title = html.H4(
-        f"Weekly listening patterns (Week {week})",
+        f"Weekly listening patterns (Week {week_number}, {year})",
         className="section-header section-header-heatmap week-title",
     )
-    df = pd.read_json(heatmap_weekly_json[week], orient="split").copy()
-    height = window_size[0] * 0.35
-    width = window_size[1]
-
-    if width < 670:
-        df = df.pivot(
-            index="hour",
-            columns="day",
-            values="Number of songs listened"
-        )
-        fig = df_to_heatmap_v(df)
-        fig.update_layout(width=width)
-        searchable = False
-    else:
-        df = df.pivot(
-            index="day",
-            columns="hour",
-            values="Number of songs listened"
-        )
-        fig = df_to_heatmap_h(df)
-        fig.update_layout(height=height)
-        searchable = True
+    vertical = window_size[1] < 670
+    size = size_bucket(window_size[1] if vertical else window_size[0] * 0.35)
 
-    if width < 670:
-        fig.update_layout(yaxis=dict(tickfont=dict(size=8)))
-        fig.update_layout(xaxis=dict(tickfont=dict(size=8)))
+    figure = figure_cache.get(
+        ("weekly", listening_data().version, week, vertical, size),
+        lambda: weekly_heatmap(heatmap_weekly(week), vertical, size),
+    )
     listening_patterns_weekly = html.Div(
-        [dcc.Graph(figure=fig)],
+        [dcc.Graph(figure=figure)],
         className="heatmap"
     )
-    return [title, listening_patterns_weekly], searchable
+    return [title, listening_patterns_weekly], not vertical
+
+
+if clientside_heatmaps:
+    # Puts the selected week's counts in the figure of the layout, without
+    # a request to the server
+    clientside_callback(
+        """
+        function(window_size, weekly, week) {
+            if (!window_size || !weekly || !weekly.weeks || week == null) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            var vertical = window_size[1] < 670;
+            var bytes = Uint8Array.from(
+                atob(weekly.counts.data), function(c) {
+                    return c.charCodeAt(0);
+                }
+            );
+            var counts = weekly.counts.dtype === "<u2"
+                ? new Uint16Array(bytes.buffer)
+                : new Uint32Array(bytes.buffer);
+            var days = weekly.counts.shape[1];
+            var hours = weekly.counts.shape[2];
+            var position = weekly.weeks.indexOf(week);
+            var cell = function(day, hour) {
+                if (position < 0) {
+                    return 0;
+                }
+                return counts[(position * days + day) * hours + hour];
+            };
+            var z = [];
+            if (vertical) {
+                for (var hour = 0; hour < hours; hour++) {
+                    var row = [];
+                    for (var day = 0; day < days; day++) {
+                        row.push(cell(day, hour));
+                    }
+                    z.push(row);
+                }
+            } else {
+                for (var day = 0; day < days; day++) {
+                    var row = [];
+                    for (var hour = 0; hour < hours; hour++) {
+                        row.push(cell(day, hour));
+                    }
+                    z.push(row);
+                }
+            }
+            var skeleton = weekly.figures[
+                vertical ? "vertical" : "horizontal"
+            ];
+            var size = vertical
+                ? {width: window_size[1]}
+                : {height: window_size[0] * 0.35};
+            var figure = {
+                data: [Object.assign(
+                    {}, skeleton.data[0], {z: z, customdata: z}
+                )],
+                layout: Object.assign({}, skeleton.layout, size),
+            };
+            var parts = week.split("-");
+            var title = "Weekly listening patterns (Week " + parts[1]
+                + ", " + parts[0] + ")";
+            return [title, figure, !vertical];
+        }
+        """,
+        Output("weekly-heatmap-title", "children"),
+        Output("weekly-heatmap", "figure"),
+        Output("dropdown-week", "searchable"),
+        Input("stored-window-size", "data"),
+        Input("stored-heatmap-weekly", "data"),
+        Input("dropdown-week", "value"),
+    )
+else:
+    callback(
+        Output("listening-patterns-weekly", "children"),
+        Output("dropdown-week", "searchable"),
+        Input("stored-window-size", "data"),
+        Input("stored-heatmap-weekly", "data"),
+        Input("dropdown-week", "value"),
+    )(listening_patterns_weekly_callback)
 
 
 @callback(
     Output("top-artists-tracks", "children"),
     Input("stored-window-size", "data"),
+    Input("date-range", "start_date"),
+    Input("date-range", "end_date"),
 )
-def top_artists_tracks_callback(window_size):
-    height = window_size[0] * 0.40
+def top_artists_tracks_callback(window_size, start_date, end_date):
+    data = listening_data()
     width = window_size[1]
-    top_artists_fig = top_artists_bar_graph(width)
-    top_tracks_fig = top_tracks_bar_graph(width)
-    if width > 670:
-        top_artists_fig.update_layout(height=height)
-        top_tracks_fig.update_layout(height=height)
+    window = date_window(data.listening_df, start_date, end_date)
+    # Only wide layouts set the height, narrow ones keep the default
+    height = size_bucket(window_size[0] * 0.40) if width > 670 else None
+
+    def builder(bar_graph):
+        def build():
+            fig = bar_graph(width, window)
+            if height is not None:
+                fig.update_layout(height=height)
+            return fig
+
+        return build
+
+    figures = [
+        figure_cache.get(
+            (name, data.version, window, width < 670, height),
+            builder(bar_graph),
+        )
+        for name, bar_graph in [
+            ("top tracks", top_tracks_bar_graph),
+            ("top artists", top_artists_bar_graph),
+        ]
+    ]
     return [
-        html.Div([dcc.Graph(figure=top_tracks_fig)], className="heatmap"),
-        html.Div([dcc.Graph(figure=top_artists_fig)], className="heatmap"),
+        html.Div([dcc.Graph(figure=figure)], className="heatmap")
+        for figure in figures
+    ]
+
+
+@callback(
+    Output("window-stats", "children"),
+    Input("date-range", "start_date"),
+    Input("date-range", "end_date"),
+)
+def window_stats_callback(start_date, end_date):
+    data = listening_data()
+    return user_stats(date_window(data.listening_df, start_date, end_date))
+
+
+def weekly_heatmap_container():
+    # Left empty for the server callback to fill, or the title and graph
+    # updated by the clientside callback
+    if not clientside_heatmaps:
+        return None
+    return [
+        html.H4(
+            id="weekly-heatmap-title",
+            className="section-header section-header-heatmap week-title",
+        ),
+        html.Div([dcc.Graph(id="weekly-heatmap")], className="heatmap"),
     ]
 
 
@@ -1081,6 +1353,8 @@ def top_artists_tracks_callback(window_size):
 def render_page_content(pathname):
     landing_pathnames = ["/", "/overview/"]
     if pathname in landing_pathnames:
+        prefetch_overview()
+        card_recent_tracks = html.Div([recent_tracks()], id="recent-tracks")
         return [
             navbar_container,
             profile_image_tooltip,
@@ -1099,7 +1373,7 @@ def render_page_content(pathname):
                 id="top-tracks-container",
             ),
             dbc.Col(
-                [profile_image, card_user_stats],
+                [profile_image, html.Div(user_stats())],
                 xs=12,
                 lg=2,
                 className="column-container",
@@ -1108,12 +1382,15 @@ def render_page_content(pathname):
         ]
     elif pathname == "/listening_patterns/":
         return [
-            navbar_container_dropdown,
+            navbar_container_dropdown(),
             dbc.Col(
                 [
                     html.Div(id="listening-patterns-yearly"),
                     dbc.Spinner(
-                        html.Div(id="listening-patterns-weekly"),
+                        html.Div(
+                            weekly_heatmap_container(),
+                            id="listening-patterns-weekly",
+                        ),
                         color="primary"
                     ),
                 ],
@@ -1124,7 +1401,7 @@ def render_page_content(pathname):
         ]
     elif pathname == "/top/":
         return [
-            navbar_container,
+            navbar_container_date_range(),
             dbc.Col(
                 [
                     dbc.Spinner(
@@ -1136,6 +1413,12 @@ def render_page_content(pathname):
                 lg=8,
                 className="column-container",
             ),
+            dbc.Col(
+                [html.Div(id="window-stats")],
+                xs=12,
+                lg=2,
+                className="column-container",
+            ),
         ]
     elif pathname == "/about/":
         return [
@@ -1155,5 +1438,30 @@ def render_page_content(pathname):
         ]
 
 
+def warm_up():
+    """Loads the data and fills the Spotify caches before they are needed"""
+    try:
+        listening_data()
+        with startup_timer.phase("spotify"):
+            prefetch_overview()
+    except Exception as error:
+        # The first request that needs them tries again
+        print(f"Warm-up failed: {error}")
+    print(startup_timer.report("Warm-up"))
+
+
+startup_timer.mark("app and layout")
+print(startup_timer.report())
+if recently_played_interval:
+    RecentlyPlayedPoller(
+        spotify_api, spotify_data_path, recently_played_interval
+    ).start()
+if lazy_startup:
+    # Not a daemon: exiting while pyarrow reads the store can crash Python
+    threading.Thread(target=warm_up, name="warm-up").start()
+else:
+    warm_up()
+
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,80 @@
+import argparse
+import json
+import timeit
+from io import StringIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from aggregates import load_aggregates
+from time_cube import cells_to_frame, decode_cells, encode_cells
+
+src_directory = Path(__file__).resolve().parent
+default_csv_path = src_directory / "streaming_history.csv"
+
+
+def frame_json(cells):
+    # The split DataFrame JSON the heatmap stores used to hold
+    return cells_to_frame(cells).to_json(date_format="iso", orient="split")
+
+
+def frame_json_cells(stored):
+    df = pd.read_json(StringIO(stored), orient="split").copy()
+    return df.pivot(
+        index="day", columns="hour", values="Number of songs listened"
+    ).to_numpy()
+
+
+def flat_list(cells):
+    return {"shape": list(cells.shape), "counts": cells.ravel().tolist()}
+
+
+def flat_list_cells(stored):
+    return np.asarray(stored["counts"]).reshape(stored["shape"])
+
+
+formats = {
+    "DataFrame JSON": (frame_json, frame_json_cells),
+    "flat list": (flat_list, flat_list_cells),
+    "base64": (encode_cells, decode_cells),
+}
+
+
+def benchmark(cells, number=200):
+    """Payload bytes and decode time in µs of each store format"""
+    results = []
+    for name, (encode, decode) in formats.items():
+        # What the browser sends back, as Dash would serialize it
+        payload = json.dumps(encode(cells))
+        assert (decode(json.loads(payload)) == cells).all()
+        seconds = timeit.timeit(
+            lambda: decode(json.loads(payload)), number=number
+        )
+        results.append((name, len(payload), seconds / number * 1e6))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the store formats of the heatmap data"
+    )
+    parser.add_argument("--csv", type=Path, default=default_csv_path)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    cube = load_aggregates(args.csv).cube
+    _, weekly_cells = cube.weekly()
+    heatmaps = {"Yearly": cube.yearly()}
+    if len(weekly_cells):
+        heatmaps["Busiest week"] = weekly_cells[
+            weekly_cells.sum(axis=(1, 2)).argmax()
+        ]
+    for title, cells in heatmaps.items():
+        print(f"{title} heatmap:")
+        for name, size, microseconds in benchmark(cells, args.number):
+            print(f"  {name:<16}{size:8} bytes{microseconds:10.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
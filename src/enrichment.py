@@ -0,0 +1,636 @@
+import argparse
+import asyncio
+import os
+import time
+from collections import deque
+from pathlib import Path
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from enrichment_cache import (
+    EnrichmentCache,
+    default_negative_ttl,
+    normalize_keys,
+)
+from enrichment_jobs import EnrichmentJob
+from history_store import (
+    audio_features,
+    end_time_format,
+    load_streaming_history,
+    store_lock,
+    write_csv,
+)
+from spotify_client import retry_after_seconds
+
+api_url = "https://api.spotify.com/v1"
+token_url = "https://accounts.spotify.com/api/token"
+# Sentinel the track dictionary has always used for failed searches
+id_not_found = "ID not found"
+dictionary_columns = ["artistName", "trackName", "trackID", *audio_features]
+
+src_directory = Path(__file__).resolve().parent
+default_csv_path = src_directory / "streaming_history.csv"
+enriched_directory = src_directory / "spotify_data" / "enriched_data"
+default_dictionary_path = enriched_directory / "track_dictionary.csv"
+default_cache_path = enriched_directory / "enrichment_cache.sqlite"
+default_job_directory = enriched_directory / "job"
+
+
+def client_credentials_token(client_id, client_secret, url=token_url):
+    """Access token of the client credentials flow (no user data)"""
+    response = requests.post(
+        url,
+        data={"grant_type": "client_credentials"},
+        auth=(client_id, client_secret),
+        timeout=10,
+    )
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+class LookupFailed(Exception):
+    """A request kept failing, unlike a search that found nothing"""
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, bursts of `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Stops handing out tokens for a while, e.g. after a 429"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate,
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Progress:
+    """Prints done/total and throughput at most every `interval` seconds"""
+
+    def __init__(self, total, label="tracks", interval=5.0):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.printed = self.started
+
+    def update(self, n=1):
+        self.done += n
+        now = time.monotonic()
+        if now - self.printed >= self.interval:
+            self.printed = now
+            print(self.summary())
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (
+            f"{self.done}/{self.total} {self.label} in {elapsed:.1f}s "
+            f"({self.done / elapsed:.1f} {self.label}/s, "
+            f"{self.requests / elapsed:.1f} requests/s, "
+            f"{self.throttled} throttled, {self.failed} failed)"
+        )
+
+
+class Batcher:
+    """Collects single-id lookups into multi-id requests.
+
+    get(id) waits until `max_size` ids are pending or `delay` seconds went
+    by, then one fetch(ids) call resolves every waiting lookup. fetch must
+    return one result per id, in order, with None for ids that failed.
+    """
+
+    def __init__(self, fetch, max_size, delay=0.05):
+        self.fetch = fetch
+        self.max_size = max_size
+        self.delay = delay
+        self.pending = {}
+        self.timer = None
+        self.requests = 0
+
+    async def get(self, key, flush=False):
+        """Result of key; flush=True sends the pending batch right away"""
+        if key not in self.pending:
+            self.pending[key] = asyncio.get_running_loop().create_future()
+        future = self.pending[key]
+        if flush or len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.delay, self.flush
+            )
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.pending:
+            keys = list(self.pending)[: self.max_size]
+            futures = [self.pending.pop(key) for key in keys]
+            asyncio.ensure_future(self.resolve(keys, futures))
+
+    async def resolve(self, keys, futures):
+        self.requests += 1
+        try:
+            results = await self.fetch(keys)
+        except Exception as error:
+            for future in futures:
+                future.set_exception(error)
+            return
+        if results is None or len(results) != len(keys):
+            results = [None] * len(keys)
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+
+class SpotifyEnricher:
+    """Looks up track ids and audio features concurrently.
+
+    At most `concurrency` requests are in flight and at most `rate` are
+    started per second. A 429 response pauses every request for the
+    Retry-After it carries. base_url can point to a local stub server for
+    testing.
+    """
+
+    def __init__(
+        self,
+        token,
+        base_url=api_url,
+        concurrency=8,
+        rate=10.0,
+        max_retries=5,
+        timeout=10,
+        refresh_token=None,
+        cache=None,
+    ):
+        self.token = token
+        # Optional EnrichmentCache consulted before any request
+        self.cache = cache
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.timeout = timeout
+        # Called (in a thread) for a new token when the current one expires
+        self.refresh_token = refresh_token
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate)
+        self.progress = Progress(0)
+        # /audio-features takes up to 100 ids per request. Searches finish
+        # at most `rate` per second, so wait about as long as filling a
+        # batch takes before sending a partial one.
+        self.features = Batcher(
+            self.fetch_audio_features, 100, delay=max(100 / rate, 0.05)
+        )
+
+    async def get(self, path, params=None):
+        """JSON body of a GET request, None if it keeps failing"""
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            async with self.semaphore:
+                try:
+                    response = await asyncio.to_thread(
+                        self.session.get,
+                        url,
+                        params=params,
+                        headers={"Authorization": f"Bearer {self.token}"},
+                        timeout=self.timeout,
+                    )
+                except (requests.ConnectionError, requests.Timeout):
+                    response = None
+            self.progress.requests += 1
+            if response is None:
+                # Like a 5xx, one slow or dropped request is not the end
+                await asyncio.sleep(min(2**attempt, 30))
+                continue
+            if response.status_code == 429:
+                self.progress.throttled += 1
+                retry_after = response.headers.get("Retry-After")
+                self.bucket.pause(retry_after_seconds(retry_after))
+                continue
+            if response.status_code == 401 and self.refresh_token:
+                self.token = await asyncio.to_thread(self.refresh_token)
+                continue
+            if response.status_code >= 500:
+                await asyncio.sleep(min(2**attempt, 30))
+                continue
+            if response.status_code != 200:
+                return None
+            return response.json()
+        return None
+
+    async def track_id(self, artist_name, track_name):
+        """Spotify id of the track, None if the search found nothing.
+
+        Raises LookupFailed when the search itself failed, so an outage is
+        not taken for a track Spotify does not have.
+        """
+        results = await self.get(
+            "search",
+            {
+                "q": f"track:{track_name} artist:{artist_name}",
+                "type": "track",
+                "limit": 1,
+            },
+        )
+        if results is None:
+            raise LookupFailed(f"{artist_name} - {track_name}")
+        try:
+            return results["tracks"]["items"][0]["id"]
+        except (TypeError, KeyError, IndexError):
+            return None
+
+    async def fetch_audio_features(self, track_ids):
+        results = await self.get(
+            "audio-features", {"ids": ",".join(track_ids)}
+        )
+        # Unknown ids come back as null entries of the list
+        return (results or {}).get("audio_features")
+
+    async def enrich_track(self, artist_name, track_name, track_id=None):
+        """Dictionary row of a track, searching its id unless given.
+
+        None when the search failed; nothing is cached then.
+        """
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.get(artist_name, track_name)
+        if cached is not None:
+            track_id, features = cached
+            if track_id is None or features:
+                self.progress.update()
+                if self.progress.done == self.progress.total:
+                    self.features.flush()
+                return dictionary_row(artist_name, track_name, *cached)
+            # Found before but without features, maybe its batch failed
+
+        failed = False
+        if track_id is None:
+            try:
+                track_id = await self.track_id(artist_name, track_name)
+            except LookupFailed:
+                failed = True
+        self.progress.update()
+        # Nothing else will join the batch once the last search is done
+        last = self.progress.done == self.progress.total
+        if track_id:
+            features = await self.features.get(track_id, flush=last)
+        else:
+            features = None
+            if last:
+                self.features.flush()
+        if failed:
+            self.progress.failed += 1
+            return None
+        if self.cache is not None:
+            self.cache.put(artist_name, track_name, track_id, features)
+        return dictionary_row(artist_name, track_name, track_id, features)
+
+    async def enrich_rows(self, tracks):
+        """Dictionary rows of (artistName, trackName, trackID) tracks.
+
+        trackID is None unless already known (e.g. from an extended
+        history export), in which case the search is skipped. Audio
+        features are requested for up to 100 tracks at a time as their ids
+        come in. Tracks whose search failed have None as their row.
+        """
+        return list(
+            await asyncio.gather(
+                *(self.enrich_track(*track) for track in tracks)
+            )
+        )
+
+    def summary(self):
+        return (
+            f"{self.progress.summary()}, "
+            f"{self.features.requests} audio features requests"
+        )
+
+    async def run_job(self, job, dictionary, dictionary_path, workers=4):
+        """Enriches the shards of an EnrichmentJob not journaled yet.
+
+        Up to `workers` shards are enriched at a time, sharing the rate
+        limit. Each finished shard is journaled, then merged into the
+        dictionary, which is rewritten atomically. A shard with failed
+        searches is not journaled, only its other rows are merged, so the
+        next run retries it. Returns the dictionary.
+        """
+        finished = job.finished()
+        # Shards journaled just before a crash may not be in the file yet
+        dictionary = merge_dictionary(
+            dictionary, [row for rows in finished.values() for row in rows]
+        )
+        pending = deque(
+            shard for shard in range(len(job.shards)) if shard not in finished
+        )
+        print(f"{len(finished)}/{len(job.shards)} shards already enriched")
+        self.progress = Progress(
+            sum(len(job.shards[shard]) for shard in pending)
+        )
+        lock = asyncio.Lock()
+
+        def checkpoint(shard, rows):
+            nonlocal dictionary
+            found = [row for row in rows if row is not None]
+            if len(found) == len(rows):
+                job.record(shard, rows)
+            dictionary = merge_dictionary(dictionary, found)
+            write_csv(dictionary, dictionary_path)
+
+        async def worker():
+            while pending:
+                shard = pending.popleft()
+                rows = await self.enrich_rows(job.shards[shard])
+                async with lock:
+                    await asyncio.to_thread(checkpoint, shard, rows)
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        print(self.summary())
+        return dictionary
+
+
+def dictionary_row(artist_name, track_name, track_id, features):
+    row = {
+        "artistName": artist_name,
+        "trackName": track_name,
+        "trackID": track_id or id_not_found,
+    }
+    for feature in audio_features:
+        row[feature] = (features or {}).get(feature)
+    return row
+
+
+def enrich_job(job, dictionary, dictionary_path, token, workers=4,
+               **options):
+    """Runs SpotifyEnricher.run_job() on its own event loop"""
+
+    async def run():
+        enricher = SpotifyEnricher(token, **options)
+        return await enricher.run_job(
+            job, dictionary, dictionary_path, workers
+        )
+
+    return asyncio.run(run())
+
+
+def read_dictionary(path):
+    """The track dictionary CSV, without the columns of older versions.
+
+    Older dictionaries also have the index, endTime and msPlayed of a play,
+    which would otherwise be rewritten empty for every new row.
+    """
+    return pd.read_csv(path).reindex(columns=dictionary_columns)
+
+
+def merge_dictionary(dictionary, rows):
+    """Dictionary with rows added, replacing entries of the same tracks"""
+    if not rows:
+        return dictionary
+    new = pd.DataFrame(rows, columns=dictionary_columns)
+    kept = dictionary[~track_keys(dictionary).isin(track_keys(new))]
+    return pd.concat([kept, new], ignore_index=True)
+
+
+def track_keys(df):
+    """Normalized (artist, track) join keys of a frame"""
+    return pd.MultiIndex.from_arrays(
+        [normalize_keys(df["artistName"]), normalize_keys(df["trackName"])]
+    )
+
+
+def pending_tracks(history, dictionary, cache=None):
+    """(artistName, trackName) pairs played but not in the dictionary.
+
+    With a cache, tracks the dictionary has as not found are pending again
+    once their cached miss expired.
+    """
+    if cache is not None:
+        missed = dictionary[dictionary["trackID"] == id_not_found]
+        expired = [
+            not cache.known_miss(artist_name, track_name)
+            for artist_name, track_name in zip(
+                missed["artistName"], missed["trackName"]
+            )
+        ]
+        dictionary = dictionary.drop(missed.index[expired])
+    played = history[["artistName", "trackName"]].drop_duplicates()
+    keys = track_keys(played)
+    played = played[~keys.isin(track_keys(dictionary)) & ~keys.duplicated()]
+    return list(played.astype(object).itertuples(index=False, name=None))
+
+
+def join_track_dictionary(history, dictionary):
+    """Fills trackID and the audio features of every play in one join.
+
+    Plays and dictionary entries are matched on their normalized
+    (artistName, trackName); plays without an entry keep what they had.
+    Returns the joined history and a match report.
+    """
+    columns = ["trackID", *audio_features]
+    dictionary = dictionary[["artistName", "trackName", *columns]].copy()
+    dictionary.index = track_keys(dictionary)
+    # Prefer entries that found an id when a key appears more than once
+    dictionary["missing"] = dictionary["trackID"].isna() | (
+        dictionary["trackID"] == id_not_found
+    )
+    dictionary = dictionary.sort_values("missing", kind="stable")
+    dictionary = dictionary[~dictionary.index.duplicated()]
+
+    position = dictionary.index.get_indexer(track_keys(history))
+    matched = position >= 0
+    joined = history.copy()
+    for column in columns:
+        values = dictionary[column].astype(history[column].dtype)
+        joined.loc[matched, column] = values.to_numpy()[position[matched]]
+
+    plays = len(history)
+    tracks = track_keys(history).unique()
+    identified = matched & ~dictionary["missing"].to_numpy()[position]
+    report = {
+        "plays": plays,
+        "matched_plays": int(matched.sum()),
+        "identified_plays": int(identified.sum()),
+        "tracks": len(tracks),
+        "matched_tracks": int(tracks.isin(dictionary.index).sum()),
+    }
+    return joined, report
+
+
+def match_summary(report):
+    plays = max(report["plays"], 1)
+    tracks = max(report["tracks"], 1)
+    return (
+        f"Matched {report['matched_plays']}/{report['plays']} plays "
+        f"({report['matched_plays'] / plays:.1%}) and "
+        f"{report['matched_tracks']}/{report['tracks']} tracks "
+        f"({report['matched_tracks'] / tracks:.1%}), "
+        f"{report['identified_plays'] / plays:.1%} of plays have a track id"
+    )
+
+
+def known_track_ids(history):
+    """(artistName, trackName) -> trackID of plays that come with an id"""
+    df = history[["artistName", "trackName", "trackID"]].dropna()
+    df = df[df["trackID"] != id_not_found].drop_duplicates(
+        ["artistName", "trackName"]
+    )
+    return {
+        (artist, track): track_id
+        for artist, track, track_id in df.itertuples(index=False, name=None)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add the played tracks missing from the track "
+        "dictionary, with their Spotify id and audio features, and join "
+        "the dictionary into the streaming history"
+    )
+    parser.add_argument("--csv", type=Path, default=default_csv_path)
+    parser.add_argument(
+        "--dictionary", type=Path, default=default_dictionary_path
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--rate", type=float, default=10.0, help="requests per second"
+    )
+    parser.add_argument("--base-url", default=api_url)
+    parser.add_argument("--token-url", default=token_url)
+    parser.add_argument("--cache", type=Path, default=default_cache_path)
+    parser.add_argument(
+        "--negative-ttl-days",
+        type=float,
+        default=default_negative_ttl / 86400,
+        help="days before a track that was not found is searched again",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="rebuild the dictionary from every played track",
+    )
+    parser.add_argument(
+        "--job-dir",
+        type=Path,
+        default=default_job_directory,
+        help="checkpoint of the running job, resumed if it was interrupted",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=50,
+        help="tracks checkpointed at a time",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="shards enriched at a time"
+    )
+    args = parser.parse_args()
+
+    history = load_streaming_history(args.csv)
+    dictionary = pd.DataFrame(columns=dictionary_columns)
+    if not args.all and args.dictionary.exists():
+        dictionary = read_dictionary(args.dictionary)
+    job = EnrichmentJob.open(args.job_dir)
+    if job is None:
+        with open_cache(args) as cache:
+            pairs = pending_tracks(history, dictionary, cache)
+        print(f"{len(pairs)} tracks to enrich")
+        if pairs:
+            job = EnrichmentJob.create(
+                args.job_dir,
+                pairs,
+                known_track_ids(history),
+                args.shard_size,
+                replace=args.all,
+            )
+    else:
+        print(f"Resuming the enrichment job in {args.job_dir}")
+    if job is not None:
+        if job.replace:
+            dictionary = pd.DataFrame(columns=dictionary_columns)
+        dictionary = enrich_missing(args, job, dictionary)
+        write_csv(dictionary, args.dictionary)
+        if job.done():
+            job.remove()
+        else:
+            print(
+                "Some searches failed, run again to retry them "
+                f"(the job is kept in {args.job_dir})"
+            )
+
+    # The job can take hours, reload the history under the store lock so
+    # plays appended meanwhile (e.g. by the poller) are not written over
+    with store_lock(args.csv):
+        history = load_streaming_history(args.csv)
+        joined, report = join_track_dictionary(history, dictionary)
+        print(match_summary(report))
+        if not joined.equals(history):
+            write_csv(joined, args.csv, date_format=end_time_format)
+
+
+def open_cache(args):
+    return EnrichmentCache(
+        args.cache, negative_ttl=args.negative_ttl_days * 86400
+    )
+
+
+def enrich_missing(args, job, dictionary):
+    def new_token():
+        return client_credentials_token(
+            os.environ["client_id"],
+            os.environ["client_secret"],
+            args.token_url,
+        )
+
+    with open_cache(args) as cache:
+        dictionary = enrich_job(
+            job,
+            dictionary,
+            args.dictionary,
+            new_token(),
+            workers=args.workers,
+            base_url=args.base_url,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            refresh_token=new_token,
+            cache=cache,
+        )
+        print(f"Cache: {cache.stats()}")
+    return dictionary
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    main()
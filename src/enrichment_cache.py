@@ -0,0 +1,141 @@
+import json
+import re
+import sqlite3
+import time
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+# Misses are looked up again after this long, a track may have been added
+default_negative_ttl = 30 * 24 * 3600
+
+
+def normalize_key(name):
+    """Case, width and whitespace insensitive form of a name"""
+    name = unicodedata.normalize("NFKC", str(name)).casefold()
+    return re.sub(r"\s+", " ", name).strip()
+
+
+class EnrichmentCache:
+    """SQLite cache of track ids and audio features.
+
+    Keyed by the normalized (artistName, trackName). Tracks the search did
+    not find are cached too, for negative_ttl seconds. Hit and miss
+    counters are kept in the database across runs.
+    """
+
+    def __init__(self, path, negative_ttl=default_negative_ttl):
+        self.negative_ttl = negative_ttl
+        self.db = sqlite3.connect(path)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tracks (
+                artist_key TEXT NOT NULL,
+                track_key TEXT NOT NULL,
+                track_id TEXT,
+                features TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (artist_key, track_key)
+            );
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            """
+        )
+        self.counts = {"hits": 0, "negative_hits": 0, "misses": 0}
+        self.uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, artist_name, track_name):
+        """(track_id, features) if cached, track_id None for a cached miss.
+
+        Returns None when the track is not cached or its miss expired.
+        """
+        row = self.db.execute(
+            "SELECT track_id, features, updated FROM tracks "
+            "WHERE artist_key = ? AND track_key = ?",
+            (normalize_key(artist_name), normalize_key(track_name)),
+        ).fetchone()
+        if row is None:
+            self.counts["misses"] += 1
+            return None
+        track_id, features, updated = row
+        if track_id is None:
+            if time.time() - updated > self.negative_ttl:
+                self.counts["misses"] += 1
+                return None
+            self.counts["negative_hits"] += 1
+        else:
+            self.counts["hits"] += 1
+        return track_id, json.loads(features) if features else None
+
+    def known_miss(self, artist_name, track_name):
+        """Whether the track is cached as not found and not expired.
+
+        Unlike get(), leaves the counters alone.
+        """
+        row = self.db.execute(
+            "SELECT updated FROM tracks WHERE artist_key = ? "
+            "AND track_key = ? AND track_id IS NULL",
+            (normalize_key(artist_name), normalize_key(track_name)),
+        ).fetchone()
+        return row is not None and time.time() - row[0] <= self.negative_ttl
+
+    def put(self, artist_name, track_name, track_id, features):
+        """Caches a track, track_id None caching a miss"""
+        self.put_many([(artist_name, track_name, track_id, features)])
+
+    def put_many(self, rows, commit_every=50):
+        """Caches (artistName, trackName, track_id, features) tuples"""
+        now = time.time()
+        rows = list(rows)
+        self.db.executemany(
+            "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    normalize_key(artist_name),
+                    normalize_key(track_name),
+                    track_id,
+                    json.dumps(features) if features else None,
+                    now,
+                )
+                for artist_name, track_name, track_id, features in rows
+            ],
+        )
+        self.uncommitted += len(rows)
+        if self.uncommitted >= commit_every:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def stats(self):
+        """Counters of this and all previous runs"""
+        totals = dict(self.db.execute("SELECT name, value FROM counters"))
+        return {
+            name: totals.get(name, 0) + count
+            for name, count in self.counts.items()
+        }
+
+    def close(self):
+        self.db.executemany(
+            "INSERT INTO counters VALUES (?, ?) ON CONFLICT(name) "
+            "DO UPDATE SET value = value + excluded.value",
+            list(self.counts.items()),
+        )
+        self.db.commit()
+        self.counts = dict.fromkeys(self.counts, 0)
+        self.db.close()
+
+
+def normalize_keys(names):
+    """normalize_key() of a Series, computed once per distinct name"""
+    codes, uniques = pd.factorize(names.astype(object))
+    normalized = np.array([normalize_key(name) for name in uniques] + [""])
+    # Missing names (code -1) map to the trailing empty key
+    return pd.Series(normalized[codes], index=names.index)
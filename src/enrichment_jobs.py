@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+from history_store import read_json, write_json
+
+
+class EnrichmentJob:
+    """Checkpointed enrichment of a fixed list of tracks.
+
+    job.json holds the tracks split in shards. Every finished shard is
+    appended to journal.jsonl with its dictionary rows, so a job that
+    stopped halfway resumes with the shards missing from the journal.
+    """
+
+    def __init__(self, directory, manifest):
+        self.directory = Path(directory)
+        self.manifest = manifest
+
+    @property
+    def journal_path(self):
+        return self.directory / "journal.jsonl"
+
+    @classmethod
+    def create(cls, directory, pairs, track_ids=None, shard_size=50,
+               replace=False):
+        """New job over (artistName, trackName) pairs.
+
+        track_ids maps pairs whose id is already known to it. replace
+        means the rows of the job make up the whole dictionary.
+        """
+        track_ids = track_ids or {}
+        tracks = [[*pair, track_ids.get(pair)] for pair in pairs]
+        manifest = {
+            "created": time.time(),
+            "replace": replace,
+            "shards": [
+                tracks[i:i + shard_size]
+                for i in range(0, len(tracks), shard_size)
+            ],
+        }
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        job = cls(directory, manifest)
+        # A journal left by an older job would mark these shards done
+        job.journal_path.unlink(missing_ok=True)
+        write_json(directory / "job.json", manifest)
+        return job
+
+    @classmethod
+    def open(cls, directory):
+        """The unfinished job in directory, None if there is none"""
+        manifest = read_json(Path(directory) / "job.json")
+        if manifest is None:
+            return None
+        job = cls(directory, manifest)
+        job.truncate_journal()
+        return job
+
+    def truncate_journal(self):
+        """Drops a last line cut short by a crash.
+
+        Otherwise the next record() would go on the end of it, and be lost
+        with it.
+        """
+        try:
+            with open(self.journal_path, "rb+") as f:
+                content = f.read()
+                f.truncate(content.rfind(b"\n") + 1)
+        except FileNotFoundError:
+            pass
+
+    @property
+    def shards(self):
+        return self.manifest["shards"]
+
+    @property
+    def replace(self):
+        return self.manifest["replace"]
+
+    def finished(self):
+        """Dictionary rows of the journaled shards, by shard number"""
+        finished = {}
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut short by a crash, redo that shard
+                        continue
+                    finished[entry["shard"]] = entry["rows"]
+        except FileNotFoundError:
+            pass
+        return finished
+
+    def done(self):
+        """Whether every shard is journaled"""
+        return len(self.finished()) == len(self.shards)
+
+    def record(self, shard, rows):
+        """Journals a finished shard, durably before returning"""
+        line = json.dumps({"shard": shard, "rows": rows}) + "\n"
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,120 @@
+import json
+from pathlib import Path
+
+import pandas as pd
+
+# Account data export (last year of plays)
+account_export_patterns = ["StreamingHistory*.json"]
+# Extended streaming history export (whole account lifetime)
+extended_export_patterns = [
+    "endsong_*.json",
+    "Streaming_History_Audio_*.json",
+]
+export_patterns = account_export_patterns + extended_export_patterns
+history_columns = ["endTime", "artistName", "trackName", "msPlayed", "trackID"]
+
+
+def find_exports(directory, patterns=export_patterns):
+    paths = set()
+    for pattern in patterns:
+        paths.update(Path(directory).glob(pattern))
+    return sorted(paths)
+
+
+def is_extended_export(path):
+    return any(Path(path).match(p) for p in extended_export_patterns)
+
+
+def iter_json_array(path, chunk_size=1 << 16):
+    """Yields the items of a top-level JSON array one at a time.
+
+    Only the current chunk and the item being decoded are held in memory,
+    whatever the size of the file.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    with open(path, "r", encoding="utf-8") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            pos = 0
+            while True:
+                while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                    pos += 1
+                if pos == len(buffer):
+                    break
+                if not started:
+                    if buffer[pos] != "[":
+                        raise ValueError(f"{path} is not a JSON array")
+                    started = True
+                    pos += 1
+                    continue
+                if buffer[pos] == "]":
+                    return
+                try:
+                    item, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # The item continues in the next chunk
+                    break
+                yield item
+            buffer = buffer[pos:]
+            if not chunk:
+                raise ValueError(f"{path} ends before its JSON array does")
+
+
+def normalize_extended(records):
+    """Streaming history rows out of extended history records.
+
+    Podcast episodes and other records without a track are dropped. `ts`
+    is the UTC time the play ended, like endTime in the account export.
+    """
+    df = pd.DataFrame.from_records(
+        records,
+        columns=[
+            "ts",
+            "master_metadata_album_artist_name",
+            "master_metadata_track_name",
+            "ms_played",
+            "spotify_track_uri",
+        ],
+    )
+    df = df.dropna(subset=["master_metadata_track_name"])
+    if df.empty:
+        # Only podcast episodes in this batch
+        return pd.DataFrame(columns=history_columns)
+    end_time = pd.to_datetime(df["ts"], utc=True).dt.tz_localize(None)
+    return pd.DataFrame(
+        {
+            "endTime": end_time.dt.floor("min"),
+            "artistName": df["master_metadata_album_artist_name"],
+            "trackName": df["master_metadata_track_name"],
+            "msPlayed": df["ms_played"],
+            # Local files have no URI
+            "trackID": df["spotify_track_uri"]
+            .astype("string")
+            .str.split(":")
+            .str[-1],
+        }
+    )
+
+
+def normalize_account(records):
+    return pd.DataFrame.from_records(
+        records, columns=["endTime", "artistName", "trackName", "msPlayed"]
+    )
+
+
+def read_batches(path, batch_size=10000):
+    """Yields the plays of an export file in frames of batch_size rows"""
+    normalize = (
+        normalize_extended if is_extended_export(path) else normalize_account
+    )
+    batch = []
+    for record in iter_json_array(path):
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield normalize(batch)
+            batch = []
+    if batch:
+        yield normalize(batch)
@@ -0,0 +1,59 @@
+import json
+import threading
+from collections import OrderedDict
+
+
+def size_bucket(pixels, step=50):
+    """Rounds a figure size so close window sizes share cached figures.
+
+    It rounds down, a figure as wide as the viewport must not overflow it.
+    """
+    return max(step, int(pixels // step) * step)
+
+
+class FigureCache:
+    """Bounded LRU cache of figures, serialized once when built.
+
+    Keys are tuples like (chart, data version, week, orientation, size
+    bucket); the data version makes entries of an older history unused
+    rather than wrong. Values are the plain dicts of the figure JSON, which
+    dcc.Graph takes as is without validating a Figure again.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.figures = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, build):
+        """The cached figure of key, or build() serialized and cached"""
+        with self.lock:
+            figure = self.figures.get(key)
+            if figure is not None:
+                self.figures.move_to_end(key)
+                self.hits += 1
+                return figure
+            self.misses += 1
+        figure = json.loads(build().to_json())
+        with self.lock:
+            self.figures[key] = figure
+            self.figures.move_to_end(key)
+            while len(self.figures) > self.maxsize:
+                self.figures.popitem(last=False)
+                self.evictions += 1
+        return figure
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.figures),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,77 @@
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where each process keeps to its own locks
+    fcntl = None
+
+
+class FileLock:
+    """Exclusive lock on a file across processes, a no-op without fcntl.
+
+    With blocking=False, acquire() returns False instead of waiting when
+    another process holds the lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        if fcntl is None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class SharedLock:
+    """Re-entrant lock held by one thread of one process at a time.
+
+    Threads of the process queue on an RLock; the process holds the
+    FileLock while any of its threads does.
+    """
+
+    def __init__(self, path):
+        self.file_lock = FileLock(path)
+        self.lock = threading.RLock()
+        self.depth = 0
+
+    def acquire(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            self.file_lock.acquire()
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            self.file_lock.release()
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,420 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from file_lock import SharedLock
+
+# Bump whenever the column dtypes below change so old artifacts get rebuilt
+SCHEMA_VERSION = 2
+
+audio_features = [
+    "danceability",
+    "energy",
+    "key",
+    "loudness",
+    "mode",
+    "speechiness",
+    "acousticness",
+    "instrumentalness",
+    "liveness",
+    "valence",
+    "tempo",
+    "time_signature",
+]
+
+csv_dtypes = {
+    "artistName": "string",
+    "trackName": "string",
+    "msPlayed": "int64",
+    "trackID": "string",
+    **{feature: "float32" for feature in audio_features},
+}
+csv_columns = ["endTime", "artistName", "trackName", "msPlayed", "trackID"]
+csv_columns += audio_features
+# Two plays are the same play when all of these match
+key_columns = ["endTime", "artistName", "trackName", "msPlayed"]
+end_time_format = "%Y-%m-%d %H:%M"
+# Appended parts are merged into the base once there are more than this,
+# so loading the store does not get slower with every poll
+max_parts = 20
+
+
+def store_dir(csv_path):
+    """Directory holding the columnar artifacts built from csv_path"""
+    csv_path = Path(csv_path)
+    return csv_path.with_name(csv_path.stem + ".store")
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    # Write to a temporary file first so readers never see half a file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def write_parquet(df, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def concat_parquet(paths, path, batch_size=65536):
+    """Writes the rows of the Parquet files at paths, in order, to path"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    schema = pq.read_schema(paths[0])
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for source in paths:
+            for batch in pq.ParquetFile(source).iter_batches(batch_size):
+                table = pa.Table.from_batches([batch])
+                writer.write_table(table.cast(schema))
+    os.replace(tmp_path, path)
+
+
+def write_csv(df, path, **kwargs):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    df.to_csv(tmp_path, index=False, lineterminator="\n", **kwargs)
+    os.replace(tmp_path, path)
+
+
+def write_npy(array, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def normalize_history(df):
+    """Gives a frame of plays the columns and dtypes of the store"""
+    df = df.reindex(columns=csv_columns).astype(csv_dtypes)
+    df["endTime"] = pd.to_datetime(df["endTime"], format=end_time_format)
+    return df
+
+
+def parse_history_csv(csv_path):
+    """Parses the streaming history CSV into properly typed columns"""
+    return normalize_history(pd.read_csv(csv_path, dtype=csv_dtypes))
+
+
+def play_keys(df):
+    """64-bit hash of the key columns of every (normalized) play"""
+    return pd.util.hash_pandas_object(df[key_columns], index=False).to_numpy()
+
+
+def csv_fingerprint(csv_path):
+    stat = os.stat(csv_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+# One lock per store, shared by the threads of the process
+store_locks = {}
+store_locks_lock = threading.Lock()
+
+
+def store_lock(csv_path):
+    """Lock held while the store is read, rebuilt or appended to.
+
+    It is re-entrant and also excludes other processes, e.g. the workers
+    of the app and a running ingest.
+    """
+    directory = store_dir(csv_path)
+    with store_locks_lock:
+        if directory not in store_locks:
+            directory.mkdir(exist_ok=True)
+            store_locks[directory] = SharedLock(directory / "lock")
+        return store_locks[directory]
+
+
+def refresh_store(csv_path):
+    """Makes sure the store reflects the CSV and returns its metadata.
+
+    The parsed frame is cached as Parquet in store_dir(csv_path) together
+    with the size, mtime and sha256 of the CSV it was built from. A matching
+    size and mtime is trusted as is; otherwise the content hash decides
+    whether the artifact has to be rebuilt. Every rebuild or append bumps
+    meta["version"], which tells derived artifacts when they are stale.
+    """
+    with store_lock(csv_path):
+        directory = store_dir(csv_path)
+        meta_path = directory / "meta.json"
+        fingerprint = csv_fingerprint(csv_path)
+        meta = read_json(meta_path)
+
+        if (
+            meta is not None
+            and meta.get("schema") == SCHEMA_VERSION
+            and (directory / meta.get("base", "base.parquet")).exists()
+        ):
+            if all(meta[k] == v for k, v in fingerprint.items()):
+                return meta
+            # Touched but not modified (e.g. a fresh git checkout)
+            sha256 = file_sha256(csv_path)
+            if meta["sha256"] == sha256:
+                meta = {**meta, **fingerprint}
+                write_json(meta_path, meta)
+                return meta
+        else:
+            sha256 = file_sha256(csv_path)
+
+        df = parse_history_csv(csv_path)
+        directory.mkdir(exist_ok=True)
+        for part in directory.glob("part-*.parquet"):
+            part.unlink()
+        for base in directory.glob("base-*.parquet"):
+            base.unlink()
+        write_parquet(df, directory / "base.parquet")
+        meta = {
+            "schema": SCHEMA_VERSION,
+            "version": (meta or {}).get("version", 0) + 1,
+            "sha256": sha256,
+            **fingerprint,
+            "base": "base.parquet",
+            "parts": [],
+            "ingested": (meta or {}).get("ingested", {}),
+        }
+        write_json(meta_path, meta)
+        return meta
+
+
+def load_streaming_history(csv_path):
+    """Loads the streaming history, parsing the CSV only when it changed"""
+    # Under the lock, so a rebuild cannot delete the parts being read
+    with store_lock(csv_path):
+        meta = refresh_store(csv_path)
+        directory = store_dir(csv_path)
+        frames = [
+            pd.read_parquet(directory / name)
+            for name in [meta.get("base", "base.parquet"), *meta["parts"]]
+        ]
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+
+def store_version(csv_path):
+    return refresh_store(csv_path)["version"]
+
+
+def saved_store_version(csv_path):
+    """Version in the store metadata, read without the store lock.
+
+    Unlike store_version() it neither waits for a writer nor notices a CSV
+    changed by hand, which makes it cheap enough for every request.
+    """
+    meta = read_json(store_dir(csv_path) / "meta.json")
+    return None if meta is None else meta.get("version")
+
+
+def known_keys(csv_path, meta):
+    """Sorted play_keys() of the whole history, cached in keys.npy"""
+    keys_path = store_dir(csv_path) / "keys.npy"
+    if meta.get("keys_version") == meta["version"] and keys_path.exists():
+        return np.load(keys_path)
+    keys = np.unique(play_keys(load_streaming_history(csv_path)))
+    write_npy(keys, keys_path)
+    meta["keys_version"] = meta["version"]
+    write_json(store_dir(csv_path) / "meta.json", meta)
+    return keys
+
+
+def covered(end_times, periods):
+    """Mask of the end times within one of the (start, end) periods"""
+    end_times = pd.Series(end_times)
+    mask = np.zeros(len(end_times), dtype=bool)
+    for start, end in periods:
+        mask |= end_times.between(start, end).to_numpy()
+    return mask
+
+
+def read_polled_keys(directory):
+    try:
+        return np.load(directory / "polled.npy")
+    except OSError:
+        return np.zeros(0, dtype="uint64")
+
+
+def remove_polled_plays(csv_path, periods):
+    """Removes the polled plays within periods, returns how many.
+
+    Polled plays have their track's duration as msPlayed and its first
+    artist rather than the album artist, so they never match the same play
+    in an export; once an export covering them is ingested they are
+    duplicates.
+    """
+    with store_lock(csv_path):
+        directory = store_dir(csv_path)
+        polled = read_polled_keys(directory)
+        if not len(polled) or not periods:
+            return 0
+        history = load_streaming_history(csv_path)
+        keys = play_keys(history)
+        removed = np.isin(keys, polled) & covered(history["endTime"], periods)
+        if removed.any():
+            write_csv(
+                history[~removed], csv_path, date_format=end_time_format
+            )
+            polled = np.setdiff1d(polled, keys[removed])
+            write_npy(polled, directory / "polled.npy")
+        return int(removed.sum())
+
+
+class HistoryAppender:
+    """Appends batches of plays that are not in the history yet.
+
+    New rows go to the end of the CSV and into a new Parquet part of the
+    store per batch, so the cost depends on the number of new plays rather
+    than on the size of the history, and memory on the batch size plus the
+    8-byte key of every known play. The store metadata is finalized once,
+    when the appender is closed.
+    """
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.directory = store_dir(csv_path)
+        # Held until close(), readers wait rather than see half an append
+        self.lock = store_lock(csv_path)
+        self.lock.acquire()
+        try:
+            self.meta = refresh_store(csv_path)
+            self.known = known_keys(csv_path, self.meta)
+            self.polled = read_polled_keys(self.directory)
+        except BaseException:
+            self.lock.release()
+            raise
+        self.appended = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, plays, polled=False):
+        """Appends the unseen plays and returns them, normalized.
+
+        polled plays, from recently played rather than an export, are
+        remembered so remove_polled_plays() can take them out again.
+        """
+        plays = normalize_history(plays)
+        keys, first = np.unique(play_keys(plays), return_index=True)
+        is_new = ~np.isin(keys, self.known, assume_unique=True)
+        plays = plays.iloc[np.sort(first[is_new])].reset_index(drop=True)
+        if plays.empty:
+            return plays
+
+        with open(self.csv_path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+        plays.to_csv(
+            self.csv_path,
+            mode="a",
+            header=False,
+            index=False,
+            date_format=end_time_format,
+            lineterminator="\n",
+        )
+        part = f"part-{len(self.meta['parts']) + 1:05d}.parquet"
+        write_parquet(plays, self.directory / part)
+        self.meta["parts"].append(part)
+        self.known = np.union1d(self.known, keys[is_new])
+        if polled:
+            self.polled = np.union1d(self.polled, keys[is_new])
+        self.appended += len(plays)
+        return plays
+
+    def is_ingested(self, path):
+        """True when this exact export file was ingested before"""
+        seen = self.meta["ingested"].get(Path(path).name)
+        if seen is None:
+            return False
+        if all(seen[k] == v for k, v in csv_fingerprint(path).items()):
+            return True
+        return seen["sha256"] == file_sha256(path)
+
+    def mark_ingested(self, path, period=None):
+        """Remembers the export file and the (start, end) of its plays"""
+        path = Path(path)
+        self.meta["ingested"][path.name] = {
+            **csv_fingerprint(path),
+            "sha256": file_sha256(path),
+        }
+        if period is not None:
+            self.meta["ingested"][path.name].update(
+                start=str(period[0]), end=str(period[1])
+            )
+
+    def ingested_periods(self):
+        """(start, end) of the plays of every export ingested"""
+        return [
+            (pd.Timestamp(seen["start"]), pd.Timestamp(seen["end"]))
+            for seen in self.meta["ingested"].values()
+            if "start" in seen
+        ]
+
+    def compact(self):
+        """Merges the base and the parts into a new base.
+
+        The files are copied one batch of rows at a time, so memory does
+        not grow with the history. The new base gets a name of its own and
+        the old files are only deleted once meta.json points to it, so a
+        crash in between leaves either the old or the new files in use,
+        never both.
+        """
+        old = [self.meta.get("base", "base.parquet"), *self.meta["parts"]]
+        base = f"base-{self.meta['version']:05d}.parquet"
+        concat_parquet(
+            [self.directory / name for name in old], self.directory / base
+        )
+        self.meta.update(base=base, parts=[])
+        write_json(self.directory / "meta.json", self.meta)
+        for name in old:
+            if name != base:
+                (self.directory / name).unlink(missing_ok=True)
+
+    def close(self):
+        if self.lock is None:
+            return
+        try:
+            if self.appended:
+                write_npy(self.known, self.directory / "keys.npy")
+                write_npy(self.polled, self.directory / "polled.npy")
+                self.meta["version"] += 1
+                self.meta["keys_version"] = self.meta["version"]
+                self.meta.update(
+                    csv_fingerprint(self.csv_path),
+                    sha256=file_sha256(self.csv_path),
+                )
+                self.appended = 0
+            if len(self.meta["parts"]) > max_parts:
+                self.compact()
+            else:
+                write_json(self.directory / "meta.json", self.meta)
+        finally:
+            self.lock.release()
+            self.lock = None
@@ -0,0 +1,99 @@
+import argparse
+from pathlib import Path
+
+from aggregates import load_aggregates
+from export_reader import find_exports, read_batches
+import pandas as pd
+
+from history_store import (
+    HistoryAppender,
+    remove_polled_plays,
+    store_lock,
+    store_version,
+)
+from listening import build_listening_frame
+
+src_directory = Path(__file__).resolve().parent
+default_csv_path = src_directory / "streaming_history.csv"
+default_export_directory = src_directory / "spotify_data"
+
+
+def ingest_plays(appender, plays, aggregates, polled=False):
+    """Appends the unseen plays and adds them to the aggregates in place"""
+    plays = appender.append(plays, polled)
+    if not plays.empty:
+        frame, _ = build_listening_frame(plays)
+        aggregates.add(frame)
+    return plays
+
+
+def ingest(csv_path, export_paths, batch_size=10000):
+    """Ingests the export files that changed since they were last seen.
+
+    Files are read batch_size records at a time, so even multi-GB extended
+    history exports are ingested in bounded memory.
+    """
+    total = 0
+    periods = []
+    # The aggregates are loaded and saved under the store lock too, so they
+    # cannot miss the plays another writer appends in between
+    with store_lock(csv_path):
+        aggregates = load_aggregates(csv_path)
+        with HistoryAppender(csv_path) as appender:
+            for path in export_paths:
+                if appender.is_ingested(path):
+                    print(f"{path.name}: already ingested")
+                    continue
+                count = 0
+                start = end = None
+                for batch in read_batches(path, batch_size):
+                    end_times = pd.to_datetime(batch["endTime"])
+                    if len(end_times):
+                        start = min(start or end_times.min(), end_times.min())
+                        end = max(end or end_times.max(), end_times.max())
+                    count += len(ingest_plays(appender, batch, aggregates))
+                period = None if start is None else (start, end)
+                appender.mark_ingested(path, period)
+                if period is not None:
+                    periods.append(period)
+                print(f"{path.name}: {count} new plays")
+                total += count
+        # The exports replace the plays polled from recently played
+        removed = remove_polled_plays(csv_path, periods)
+        if removed:
+            print(f"Replaced {removed} polled plays")
+            # Rebuilt from the history without them
+            load_aggregates(csv_path)
+        else:
+            aggregates.save(csv_path, store_version(csv_path))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Append new Spotify data exports (StreamingHistory*.json "
+        "or extended endsong_*.json / Streaming_History_Audio_*.json) to "
+        "the streaming history"
+    )
+    parser.add_argument(
+        "exports",
+        nargs="?",
+        type=Path,
+        default=default_export_directory,
+        help="directory holding the Spotify data export",
+    )
+    parser.add_argument("--csv", type=Path, default=default_csv_path)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=10000,
+        help="number of records parsed and written at a time",
+    )
+    args = parser.parse_args()
+
+    total = ingest(args.csv, find_exports(args.exports), args.batch_size)
+    print(f"Ingested {total} new plays")
+
+
+if __name__ == "__main__":
+    main()
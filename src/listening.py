@@ -0,0 +1,94 @@
+import pandas as pd
+
+from history_store import audio_features
+
+
+def build_listening_frame(df, compact=True):
+    """Derives the calendar columns every aggregation needs, once.
+
+    Returns the play log and a track table with one row per (artistName,
+    trackName), indexed by the play log's `trackCode`. Both are sorted by
+    endTime and shared by all callbacks, so they must be treated as
+    read-only: aggregate them, never modify them in place. `year` and `week`
+    are the ISO calendar year and week, which keeps (year, week) unique
+    across New Year.
+
+    In compact mode names are dictionary encoded, counters use the narrowest
+    integer type that fits and the audio features are only kept once per
+    track in the track table. Otherwise they are repeated on every play.
+    """
+    end_time = pd.to_datetime(df["endTime"], format="%Y-%m-%d %H:%M")
+    order = end_time.argsort(kind="stable").to_numpy()
+    df = df.iloc[order].reset_index(drop=True)
+    end_time = end_time.iloc[order].reset_index(drop=True)
+    iso = end_time.dt.isocalendar()
+
+    track_codes, track_keys = pd.MultiIndex.from_arrays(
+        [df["artistName"], df["trackName"]]
+    ).factorize()
+    first_play = pd.Series(range(len(df))).groupby(track_codes).first()
+    tracks = df.loc[
+        first_play.to_numpy(),
+        ["artistName", "trackName", "trackID", *audio_features]
+    ].reset_index(drop=True)
+    tracks.index.name = "trackCode"
+
+    if compact:
+        name_type, ms_type, small_type, year_type = (
+            "category", "int32", "uint8", "uint16"
+        )
+        tracks = tracks.astype(
+            {"artistName": "category", "trackName": "category"}
+        )
+    else:
+        name_type, ms_type, small_type, year_type = (
+            "object", "int64", "int64", "int64"
+        )
+
+    frame = pd.DataFrame(
+        {
+            "endTime": end_time,
+            "artistName": df["artistName"].astype(name_type),
+            "trackName": df["trackName"].astype(name_type),
+            "trackID": df["trackID"].astype(name_type),
+            "trackCode": track_codes.astype("int32"),
+            "msPlayed": df["msPlayed"].astype(ms_type),
+            "minutesPlayed": (df["msPlayed"] / 60000).astype("float32"),
+            "date": end_time.dt.normalize(),
+            "year": iso["year"].astype(year_type),
+            "week": iso["week"].astype(small_type),
+            "day": end_time.dt.dayofweek.astype(small_type),
+            "hour": end_time.dt.hour.astype(small_type),
+        }
+    )
+    if not compact:
+        frame = pd.concat([frame, df[audio_features]], axis=1)
+    return frame, tracks
+
+
+def memory_report(frame, tracks):
+    frame_mb = frame.memory_usage(deep=True).sum() / 2**20
+    tracks_mb = tracks.memory_usage(deep=True).sum() / 2**20
+    return (
+        f"Listening data: {len(frame)} plays ({frame_mb:.1f} MB), "
+        f"{len(tracks)} tracks ({tracks_mb:.1f} MB)"
+    )
+
+
+def date_window(frame, start_date=None, end_date=None):
+    """(start, stop) rows of the plays between both dates, inclusive.
+
+    The play log is sorted by endTime, so this is two binary searches.
+    Returns None when neither date is given, i.e. for the whole history.
+    """
+    if start_date is None and end_date is None:
+        return None
+    end_times = frame["endTime"].to_numpy()
+    start, stop = 0, len(end_times)
+    if start_date is not None:
+        start_time = pd.Timestamp(start_date).normalize().to_datetime64()
+        start = end_times.searchsorted(start_time, side="left")
+    if end_date is not None:
+        stop_time = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)
+        stop = end_times.searchsorted(stop_time.to_datetime64(), side="left")
+    return int(start), int(max(start, stop))
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+
+class TopK:
+    """Top artists and tracks computed on integer codes.
+
+    Totals per artist or track are a single bincount over the codes of the
+    plays in the window, the top N are picked with argpartition and every
+    ranking is memoized, so redrawing a chart never re-aggregates the plays.
+    A window is a (start, stop) row range of the time sorted play log, or
+    None for the whole history. The memo belongs to the instance, and goes
+    away with it when the data is reloaded.
+
+    Given the Aggregates of the same history, whole-history totals come
+    from its persisted per-artist and per-track totals instead.
+    """
+
+    def __init__(self, frame, tracks, aggregates=None):
+        artists = frame["artistName"]
+        if isinstance(artists.dtype, pd.CategoricalDtype):
+            artist_codes = artists.cat.codes.to_numpy()
+            artist_names = artists.cat.categories.to_numpy()
+        else:
+            artist_codes, artist_names = pd.factorize(artists)
+        self.codes = {
+            "artist": artist_codes.astype("int32"),
+            "track": frame["trackCode"].to_numpy(),
+        }
+        self.sizes = {"artist": len(artist_names), "track": len(tracks)}
+        self.artist_names = np.asarray(artist_names, dtype=object)
+        self.tracks = tracks[["artistName", "trackName"]].astype(object)
+        self.ms_played = frame["msPlayed"].to_numpy()
+        self.saved = {}
+        if aggregates is not None:
+            self.saved = {
+                "artist": aggregates.artists.reindex(
+                    self.artist_names, fill_value=0
+                ),
+                "track": aggregates.tracks.reindex(
+                    pd.MultiIndex.from_frame(self.tracks), fill_value=0
+                ),
+            }
+        self.memo = {}
+
+    def memoized(self, key, compute, maxsize=512):
+        value = self.memo.get(key)
+        if value is None:
+            value = compute()
+            if len(self.memo) >= maxsize:
+                # Forget the oldest entry
+                self.memo.pop(next(iter(self.memo), None), None)
+            self.memo[key] = value
+        return value
+
+    def totals(self, entity, metric="minutes", window=None):
+        """Minutes or plays per artist/track code within the window"""
+        if window is None and entity in self.saved:
+            saved = self.saved[entity]
+            if metric == "plays":
+                return saved["plays"].to_numpy()
+            if metric == "minutes":
+                return saved["msPlayed"].to_numpy() / 60000
+        start, stop = window if window is not None else (None, None)
+        codes = self.codes[entity][start:stop]
+        if metric == "plays":
+            return np.bincount(codes, minlength=self.sizes[entity])
+        if metric != "minutes":
+            raise ValueError(f"Unknown metric: {metric}")
+        ms_played = np.bincount(
+            codes,
+            weights=self.ms_played[start:stop],
+            minlength=self.sizes[entity],
+        )
+        return ms_played / 60000
+
+    def ranking(self, entity, metric="minutes", window=None, n=15):
+        """(codes, totals) of the n biggest entities, biggest first"""
+        def compute():
+            totals = self.totals(entity, metric, window)
+            count = min(n, np.count_nonzero(totals))
+            if count == 0:
+                return np.empty(0, "int64"), np.empty(0, totals.dtype)
+            top = np.argpartition(-totals, count - 1)[:count]
+            top = top[np.lexsort((top, -totals[top]))]
+            return top, totals[top]
+
+        return self.memoized(("ranking", entity, metric, window, n), compute)
+
+    def distinct(self, entity, window=None):
+        """Number of artists/tracks played at least once in the window"""
+        return self.memoized(
+            ("distinct", entity, window),
+            lambda: int(
+                np.count_nonzero(self.totals(entity, "plays", window))
+            ),
+        )
+
+    def top(self, entity, metric="minutes", window=None, n=15):
+        codes, totals = self.ranking(entity, metric, window, n)
+        if entity == "artist":
+            df = pd.DataFrame({"artistName": self.artist_names[codes]})
+        else:
+            df = self.tracks.iloc[codes].reset_index(drop=True)
+        if metric == "minutes":
+            df["Minutes Listened"] = totals.round()
+        else:
+            df["Plays"] = totals
+        return df
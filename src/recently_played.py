@@ -0,0 +1,174 @@
+import argparse
+import atexit
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+from aggregates import load_aggregates
+from file_lock import FileLock
+from history_store import (
+    HistoryAppender,
+    read_json,
+    store_dir,
+    covered,
+    store_lock,
+    store_version,
+    write_json,
+)
+from ingest import ingest_plays
+from spotify_client import SpotifyClient
+
+src_directory = Path(__file__).resolve().parent
+default_csv_path = src_directory / "streaming_history.csv"
+# Spotify returns at most 50 plays per request, a few hours of listening
+default_interval = 600
+page_size = 50
+
+
+def recently_played_plays(items):
+    """Streaming history rows of /me/player/recently-played items.
+
+    played_at is the UTC time the play ended, like endTime in the exports.
+    The API does not say for how long a track was played, so msPlayed is
+    its duration.
+    """
+    return pd.DataFrame(
+        {
+            "endTime": pd.to_datetime(
+                [item["played_at"] for item in items],
+                utc=True,
+                # With or without milliseconds, depending on the play
+                format="ISO8601",
+            )
+            .tz_localize(None)
+            .floor("min"),
+            "artistName": [
+                item["track"]["artists"][0]["name"] for item in items
+            ],
+            "trackName": [item["track"]["name"] for item in items],
+            "msPlayed": [item["track"]["duration_ms"] for item in items],
+            "trackID": [item["track"]["id"] for item in items],
+        }
+    )
+
+
+def fetch_recently_played(client, after=None, max_pages=10):
+    """Plays since the `after` cursor (ms) and the cursor of the newest"""
+    items = []
+    for _ in range(max_pages):
+        params = {"limit": page_size}
+        if after is not None:
+            params["after"] = after
+        data = client.get("me/player/recently-played", params, stale_ok=False)
+        page = data.get("items") or []
+        items += page
+        after = (data.get("cursors") or {}).get("after", after)
+        if len(page) < page_size:
+            break
+    return items, after
+
+
+def poll(client, csv_path):
+    """Appends the plays since the last poll, returns how many were new.
+
+    The cursor is kept in the history store, overlapping plays are dropped
+    by the appender, and the aggregates are updated in place.
+    """
+    state_path = store_dir(csv_path) / "recently_played.json"
+    after = (read_json(state_path) or {}).get("after")
+    # Fetched before taking the store lock, readers never wait on Spotify
+    items, after = fetch_recently_played(client, after)
+    count = 0
+    if items:
+        # Loaded and saved under the lock, like in ingest()
+        with store_lock(csv_path):
+            aggregates = load_aggregates(csv_path)
+            with HistoryAppender(csv_path) as appender:
+                plays = recently_played_plays(items)
+                # Exports already hold these plays, with the real msPlayed
+                plays = plays[
+                    ~covered(plays["endTime"], appender.ingested_periods())
+                ]
+                count = len(
+                    ingest_plays(appender, plays, aggregates, polled=True)
+                )
+            if count:
+                aggregates.save(csv_path, store_version(csv_path))
+    write_json(state_path, {"after": after})
+    return count
+
+
+class RecentlyPlayedPoller:
+    """Calls poll() every `interval` seconds in a background thread.
+
+    Of all the gunicorn workers, only the one holding the poller lock
+    polls; the others keep trying to take it over.
+    """
+
+    def __init__(self, client, csv_path, interval=default_interval):
+        self.client = client
+        self.csv_path = csv_path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="recently-played", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        # Let a poll in progress finish its writes before Python exits
+        atexit.register(self.stop)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join(timeout=30)
+
+    def run(self):
+        lock = FileLock(store_dir(self.csv_path) / "poller.lock")
+        held = False
+        while not self.stopped.is_set():
+            held = held or lock.acquire(blocking=False)
+            if held:
+                try:
+                    count = poll(self.client, self.csv_path)
+                    if count:
+                        print(f"Recently played: {count} new plays")
+                except Exception as error:
+                    # Whatever it was, the next poll tries again
+                    print(f"Polling recently played failed: {error!r}")
+            self.stopped.wait(self.interval)
+        lock.release()
+
+
+def main():
+    # Reads the Spotify credentials at import
+    from refresh import access_token
+
+    parser = argparse.ArgumentParser(
+        description="Append the plays of Spotify's recently played list to "
+        "the streaming history"
+    )
+    parser.add_argument("--csv", type=Path, default=default_csv_path)
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0,
+        help="keep polling every this many seconds instead of once",
+    )
+    args = parser.parse_args()
+
+    client = SpotifyClient(access_token)
+    if not args.interval:
+        print(f"Appended {poll(client, args.csv)} new plays")
+        return
+    poller = RecentlyPlayedPoller(client, args.csv, args.interval)
+    poller.start()
+    try:
+        poller.thread.join()
+    except KeyboardInterrupt:
+        poller.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
 import os
-import requests
 import json
+import requests
+import tempfile
+import threading
+import time
 from dotenv import load_dotenv
+from file_lock import FileLock
+from spotify_client import request
 
 #Load environment variables
 load_dotenv()
@@ -11,17 +16,25 @@ redirect_uri = os.environ['redirect_uri']
 refresh_token = os.environ['refresh_token']
 base_64 = os.environ['base_64']
 
+# Shared by the gunicorn workers of the app
+default_token_path = os.environ.get(
+    "SPOTIFY_TOKEN_CACHE",
+    os.path.join(tempfile.gettempdir(), "spotify_analyzer_token.json"),
+)
+
 class Refresh:
 
     def __init__(self):
         self.refresh_token = refresh_token
         self.base_64 = base_64
 
-    def refresh(self):
+    def request_token(self):
+        """New access token and the number of seconds it is valid"""
 
         query = "https://accounts.spotify.com/api/token"
 
-        response = requests.post(
+        response = request(
+            "POST",
             query,
             data={
                 "grant_type": "refresh_token",
@@ -31,10 +44,95 @@ class Refresh:
                 "Authorization": "Basic " + base_64
             }
         )
+        response.raise_for_status()
 
         response_json = response.json()
-        return response_json["access_token"]
+        return response_json["access_token"], response_json["expires_in"]
+
+    def refresh(self):
+        return self.request_token()[0]
+
+
+class AccessToken:
+    """Access token cached until `margin` seconds before it expires.
+
+    The token is kept in memory and in a file shared by every process of
+    the app. Only one thread or process refreshes it at a time, the others
+    wait for the lock and then read the new token. After a failed refresh,
+    calls fail right away for `failure_backoff` seconds.
+    """
+
+    def __init__(self, path=default_token_path, margin=60,
+                 request_token=None, failure_backoff=10):
+        self.path = path
+        self.margin = margin
+        self.failure_backoff = failure_backoff
+        self.failed_at = None
+        self.request_token = request_token or Refresh().request_token
+        self.token = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+
+    def valid(self):
+        return time.time() < self.expires_at - self.margin
+
+    def get(self):
+        if self.valid():
+            return self.token
+        with self.lock:
+            if self.valid():
+                return self.token
+            if self.read() and self.valid():
+                return self.token
+            if (
+                self.failed_at is not None
+                and time.monotonic() - self.failed_at < self.failure_backoff
+            ):
+                raise requests.ConnectionError("token refresh failed")
+            with self.file_lock():
+                # Another process may have refreshed it while we waited
+                if self.read() and self.valid():
+                    return self.token
+                try:
+                    token, expires_in = self.request_token()
+                except (requests.RequestException, ValueError, KeyError):
+                    self.failed_at = time.monotonic()
+                    raise
+                self.failed_at = None
+                self.token = token
+                self.expires_at = time.time() + expires_in
+                self.write()
+        return self.token
+
+    def invalidate(self):
+        """Drops the token, e.g. after a 401 response"""
+        with self.lock:
+            self.expires_at = 0.0
+            self.write()
+
+    def read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            self.token = cached["access_token"]
+            self.expires_at = cached["expires_at"]
+        except (OSError, ValueError, KeyError):
+            return False
+        return True
+
+    def write(self):
+        # Readable by the owner only, replaced atomically
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(
+                {"access_token": self.token, "expires_at": self.expires_at},
+                f,
+            )
+        os.replace(tmp_path, self.path)
+
+    def file_lock(self):
+        return FileLock(f"{self.path}.lock")
 
 
-a = Refresh()
-a.refresh()
+access_token = AccessToken()
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from file_lock import FileLock
+
+# Shared by the gunicorn workers of the app
+default_cache_directory = os.environ.get(
+    "SPOTIFY_RESPONSE_CACHE",
+    os.path.join(tempfile.gettempdir(), "spotify_analyzer_responses"),
+)
+# Seconds a response stays fresh. Top tracks are recomputed by Spotify
+# about once a day, recently played changes with every song.
+default_ttls = {
+    "me/top/tracks": 3600,
+    "me/player/recently-played": 60,
+}
+
+
+def cache_key(path, params=None):
+    return json.dumps([path, sorted((params or {}).items())])
+
+
+class ResponseCache:
+    """Stale-while-revalidate cache in front of a SpotifyClient.
+
+    Responses are kept in memory and in a directory shared by the workers,
+    keyed by (endpoint, params), each endpoint with its own TTL. A stale
+    response is returned right away while a background thread fetches a
+    new one; only one thread across the workers refreshes a key at a time.
+    Callers only wait when there is no response at all yet.
+    """
+
+    def __init__(self, client, ttls=default_ttls,
+                 directory=default_cache_directory, default_ttl=300):
+        self.client = client
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.entries = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def get(self, path, params=None):
+        key = cache_key(path, params)
+        entry = self.entries.get(key)
+        if entry is None or self.stale(path, entry):
+            # Another worker may have fetched it already
+            entry = self.read(key) or entry
+        if entry is None:
+            return self.fetch(path, params, key)
+        if self.stale(path, entry):
+            self.revalidate(path, params, key)
+        return entry["data"]
+
+    def stale(self, path, entry):
+        ttl = self.ttls.get(path, self.default_ttl)
+        return time.time() - entry["fetched"] >= ttl
+
+    def fetch(self, path, params, key):
+        data = self.client.get(path, params, stale_ok=False)
+        entry = {"fetched": time.time(), "data": data}
+        self.entries[key] = entry
+        self.write(key, entry)
+        return data
+
+    def revalidate(self, path, params, key):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        threading.Thread(
+            target=self.refresh, args=(path, params, key), daemon=True
+        ).start()
+
+    def refresh(self, path, params, key):
+        lock = FileLock(f"{self.file_path(key)}.lock")
+        try:
+            # Skip it if another worker is refreshing the same key
+            if lock.acquire(blocking=False):
+                entry = self.read(key)
+                if entry is None or self.stale(path, entry):
+                    self.fetch(path, params, key)
+                else:
+                    self.entries[key] = entry
+        except Exception as error:
+            # The stale response keeps being served
+            print(f"Refreshing {path} failed: {error}")
+        finally:
+            lock.release()
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def file_path(self, key):
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.json")
+
+    def read(self, key):
+        try:
+            with open(self.file_path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, key, entry):
+        path = self.file_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
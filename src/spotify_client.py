@@ -0,0 +1,202 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+api_url = "https://api.spotify.com/v1"
+# (connect, read) seconds, so a slow response cannot hang a worker
+default_timeout = (3.05, 10)
+# Seconds a call may take with all its retries, the retry with a new token
+# after a 401 included. The token refreshes it may need have a deadline of
+# their own, which still keeps it under gunicorn's 30 s worker timeout.
+default_deadline = 8.0
+
+
+class SpotifyUnavailable(Exception):
+    """The API is failing and there is no earlier response to fall back on"""
+
+
+def new_session(pool_size=10):
+    """Session keeping up to pool_size connections per host alive"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared by every thread of the process; requests sessions are thread-safe
+# for plain requests like these
+session = new_session()
+
+
+def retry_after_seconds(value, default=1.0):
+    """Seconds to wait of a Retry-After header, in seconds or an HTTP date"""
+    if value is None:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+def retry_delay(response, attempt, backoff, max_backoff):
+    """Seconds to wait before retrying, Retry-After if the API sent one"""
+    # Full jitter keeps the workers from retrying in lockstep
+    jitter = random.uniform(0, min(max_backoff, backoff * 2**attempt))
+    if response is None:
+        return jitter
+    return retry_after_seconds(response.headers.get("Retry-After"), jitter)
+
+
+def request(method, url, timeout=default_timeout, max_retries=3, backoff=0.5,
+            max_backoff=8.0, deadline=default_deadline, **kwargs):
+    """requests.request() on the shared session, retrying transient errors.
+
+    Connection errors, timeouts, 429 and 5xx responses are retried up to
+    max_retries times with exponential backoff, or after Retry-After. A
+    wait longer than max_backoff, or past the deadline (seconds for the
+    whole call), is not worth holding a request for: the last response is
+    returned (or the error raised) instead. Each attempt's timeouts are cut
+    to the time left.
+    """
+    ends = time.monotonic() + deadline
+    connect_timeout, read_timeout = (
+        timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    )
+    for attempt in range(max_retries + 1):
+        left = max(ends - time.monotonic(), 0.01)
+        response = None
+        try:
+            response = session.request(
+                method,
+                url,
+                timeout=(min(connect_timeout, left), min(read_timeout, left)),
+                **kwargs,
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+        else:
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            if attempt == max_retries:
+                return response
+        delay = retry_delay(response, attempt, backoff, max_backoff)
+        if delay > max_backoff or time.monotonic() + delay >= ends:
+            if response is None:
+                raise requests.Timeout(f"{url}: no response in {deadline}s")
+            return response
+        time.sleep(delay)
+
+
+class CircuitBreaker:
+    """Stops calling a failing API for a while.
+
+    After failure_threshold failures in a row the circuit opens and
+    allow() is False for reset_timeout seconds. Then one call is let
+    through, which closes the circuit if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half open, the next failure opens it again right away
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+
+class SpotifyClient:
+    """Web API client serving the last good data while the API fails.
+
+    token is an object with get() and invalidate(), like
+    refresh.access_token. Responses are remembered per (path, params), and
+    returned when a call fails or the circuit breaker is open.
+    """
+
+    def __init__(self, token, base_url=api_url, breaker=None, **options):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.breaker = breaker or CircuitBreaker()
+        # Passed on to request(): timeout, max_retries, backoff...
+        self.options = options
+        self.last_good = {}
+
+    def get(self, path, params=None, stale_ok=True):
+        """JSON body of GET path, the last good one if the API fails.
+
+        With stale_ok=False SpotifyUnavailable is raised instead, for
+        callers that keep their own copy.
+        """
+        key = (path, tuple(sorted((params or {}).items())))
+        if not self.breaker.allow():
+            return self.fallback(key, "circuit open", stale_ok)
+        try:
+            data = self.fetch(path, params)
+        except (requests.RequestException, ValueError) as error:
+            self.breaker.record_failure()
+            return self.fallback(key, error, stale_ok)
+        self.breaker.record_success()
+        self.last_good[key] = data
+        return data
+
+    def fetch(self, path, params):
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        options = dict(self.options)
+        # One deadline for both calls when the first one gets a 401
+        ends = time.monotonic() + options.pop("deadline", default_deadline)
+        for _ in range(2):
+            headers = {"Authorization": f"Bearer {self.token.get()}"}
+            response = request(
+                "GET",
+                url,
+                params=params,
+                headers=headers,
+                deadline=ends - time.monotonic(),
+                **options,
+            )
+            if response.status_code != 401:
+                break
+            # Revoked or expired early, retry once with a new token
+            self.token.invalidate()
+        response.raise_for_status()
+        return response.json()
+
+    def fallback(self, key, reason, stale_ok=True):
+        if stale_ok and key in self.last_good:
+            print(f"Spotify API unavailable ({reason}), serving last data")
+            return self.last_good[key]
+        raise SpotifyUnavailable(reason)
@@ -0,0 +1,40 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """Times the startup phases of a worker, for the startup report.
+
+    mark() ends a phase that started at the previous mark, phase() times a
+    block of its own, e.g. in the background warm-up thread.
+    """
+
+    def __init__(self, started=None):
+        self.started = started or time.perf_counter()
+        self.last = self.started
+        self.phases = []
+        self.lock = threading.Lock()
+
+    def mark(self, name):
+        with self.lock:
+            now = time.perf_counter()
+            self.phases.append((name, now - self.last))
+            self.last = now
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append((name, time.perf_counter() - started))
+
+    def report(self, title="Startup"):
+        with self.lock:
+            phases = list(self.phases)
+        lines = [f"{title} of worker {os.getpid()}:"]
+        lines += [f"  {name:<16}{seconds:8.3f}s" for name, seconds in phases]
+        return "\n".join(lines)
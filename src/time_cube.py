@@ -0,0 +1,169 @@
+import base64
+import os
+
+import numpy as np
+import pandas as pd
+
+# ISO weeks run from 1 to 53, index 0 of the week axis stays empty
+WEEKS, DAYS, HOURS = 54, 7, 24
+
+
+class TimeCube:
+    """Play counts and ms played per (ISO year, ISO week, weekday, hour).
+
+    Every heatmap and listening stat is a slice or a sum over this array,
+    so none of them needs to go back to the individual plays.
+    """
+
+    def __init__(self, first_year, counts, ms_played):
+        self.first_year = first_year
+        self.counts = counts
+        self.ms_played = ms_played
+
+    @classmethod
+    def from_frame(cls, frame):
+        if frame.empty:
+            shape = (0, WEEKS, DAYS, HOURS)
+            return cls(0, np.zeros(shape, "uint32"), np.zeros(shape, "int64"))
+        years = frame["year"].to_numpy().astype("int64")
+        first_year = int(years.min())
+        n_years = int(years.max()) - first_year + 1
+        index = cell_index(
+            years - first_year,
+            frame["week"].to_numpy(),
+            frame["day"].to_numpy(),
+            frame["hour"].to_numpy(),
+        )
+        size = n_years * WEEKS * DAYS * HOURS
+        shape = (n_years, WEEKS, DAYS, HOURS)
+        counts = np.bincount(index, minlength=size).astype("uint32")
+        ms_played = np.bincount(
+            index, weights=frame["msPlayed"].to_numpy(), minlength=size
+        ).astype("int64")
+        return cls(first_year, counts.reshape(shape), ms_played.reshape(shape))
+
+    def add(self, frame):
+        """Adds the plays of frame to the cube in place"""
+        if frame.empty:
+            return
+        other = TimeCube.from_frame(frame)
+        if len(self.counts) == 0:
+            self.first_year = other.first_year
+            self.counts, self.ms_played = other.counts, other.ms_played
+            return
+        first_year = min(self.first_year, other.first_year)
+        last_year = max(self.years[-1], other.years[-1])
+        if first_year < self.first_year or last_year > self.years[-1]:
+            before = self.first_year - first_year
+            after = last_year - self.years[-1]
+            pad = ((before, after), (0, 0), (0, 0), (0, 0))
+            self.counts = np.pad(self.counts, pad)
+            self.ms_played = np.pad(self.ms_played, pad)
+            self.first_year = first_year
+        start = other.first_year - self.first_year
+        stop = start + len(other.counts)
+        self.counts[start:stop] += other.counts
+        self.ms_played[start:stop] += other.ms_played
+
+    def save(self, path, version):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=version,
+                first_year=self.first_year,
+                counts=self.counts,
+                ms_played=self.ms_played,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, version):
+        """The cube saved at path, or None if missing or not at version"""
+        try:
+            with np.load(path) as data:
+                if int(data["version"]) != version:
+                    return None
+                return cls(
+                    int(data["first_year"]), data["counts"], data["ms_played"]
+                )
+        except (OSError, KeyError, ValueError):
+            return None
+
+    @property
+    def years(self):
+        return range(self.first_year, self.first_year + len(self.counts))
+
+    def yearly(self):
+        """7x24 play counts over the whole history"""
+        return self.counts.sum(axis=(0, 1))
+
+    def weekly(self):
+        """(year, week) keys and 7x24 counts of every week with plays.
+
+        The counts come back as one dense (weeks, 7, 24) array, in
+        chronological order, so a week is looked up by position.
+        """
+        cells = self.counts.reshape(-1, DAYS, HOURS)
+        played = np.flatnonzero(cells.any(axis=(1, 2)))
+        keys = [
+            (self.first_year + int(i) // WEEKS, int(i) % WEEKS)
+            for i in played
+        ]
+        return keys, cells[played]
+
+    def total_plays(self):
+        return int(self.counts.sum())
+
+    def total_ms(self):
+        return int(self.ms_played.sum())
+
+
+def cell_index(year_offset, week, day, hour):
+    year_offset = np.asarray(year_offset, dtype="int64")
+    return ((year_offset * WEEKS + week) * DAYS + day) * HOURS + hour
+
+
+def cells_to_frame(cells, value_name="Number of songs listened"):
+    """Long (day, hour, value) frame out of a 7x24 array"""
+    day, hour = np.indices(cells.shape)
+    return pd.DataFrame(
+        {
+            "day": day.ravel(),
+            "hour": hour.ravel(),
+            value_name: cells.ravel(),
+        }
+    )
+
+
+def day_hour_cells(frame, window):
+    """7x24 play counts of the (start, stop) row range of the play log"""
+    start, stop = window
+    index = (
+        frame["day"].to_numpy()[start:stop].astype("int64") * HOURS
+        + frame["hour"].to_numpy()[start:stop]
+    )
+    counts = np.bincount(index, minlength=DAYS * HOURS)
+    return counts.reshape(DAYS, HOURS)
+
+
+def encode_cells(cells):
+    """JSON-safe compact form of a 7x24 count array, for dcc.Store.
+
+    The counts are kept as base64 of little-endian uint16, or uint32 when
+    a cell does not fit, along with the shape to restore.
+    """
+    cells = np.asarray(cells)
+    dtype = "<u2" if cells.size == 0 or cells.max() < 2**16 else "<u4"
+    return {
+        "dtype": dtype,
+        "shape": list(cells.shape),
+        "data": base64.b64encode(cells.astype(dtype).tobytes()).decode(),
+    }
+
+
+def decode_cells(stored):
+    """Read-only count array of encode_cells() output, without parsing"""
+    return np.frombuffer(
+        base64.b64decode(stored["data"]), dtype=stored["dtype"]
+    ).reshape(stored["shape"])
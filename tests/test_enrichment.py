@@ -0,0 +1,182 @@
+import asyncio
+import json
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import pandas as pd  # noqa: E402
+
+from enrichment import (  # noqa: E402
+    LookupFailed,
+    SpotifyEnricher,
+    id_not_found,
+    pending_tracks,
+)
+from enrichment_cache import EnrichmentCache  # noqa: E402
+from spotify_client import retry_after_seconds  # noqa: E402
+
+search_result = {"tracks": {"items": [{"id": "4uLU6hMCjMI75M1A2tKUQC"}]}}
+
+
+class StubSpotify(BaseHTTPRequestHandler):
+    """Serves the queued (status, headers, delay) responses, then 200s"""
+
+    responses = []
+    requests = 0
+    result = search_result
+
+    def do_GET(self):
+        cls = type(self)
+        cls.requests += 1
+        status, headers, delay = (
+            cls.responses.pop(0) if cls.responses else (200, {}, 0)
+        )
+        time.sleep(delay)
+        body = json.dumps(cls.result if status == 200 else {}).encode()
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # The client gave up waiting
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class SpotifyEnricherTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubSpotify)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}/v1"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubSpotify.responses = []
+        StubSpotify.requests = 0
+        StubSpotify.result = search_result
+
+    def track_id(self, **options):
+        async def run():
+            enricher = SpotifyEnricher(
+                "token", base_url=self.base_url, rate=100, **options
+            )
+            track_id = await enricher.track_id("Artist", "Track")
+            return track_id, enricher.progress
+
+        return asyncio.run(run())
+
+    def test_waits_for_retry_after_of_a_429(self):
+        StubSpotify.responses = [(429, {"Retry-After": "0.5"}, 0)]
+        started = time.monotonic()
+        track_id, progress = self.track_id()
+        self.assertEqual(track_id, "4uLU6hMCjMI75M1A2tKUQC")
+        self.assertEqual(progress.throttled, 1)
+        self.assertEqual(StubSpotify.requests, 2)
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+
+    def test_retry_after_as_an_http_date(self):
+        retry_after = formatdate(time.time(), usegmt=True)
+        StubSpotify.responses = [(429, {"Retry-After": retry_after}, 0)]
+        track_id, progress = self.track_id()
+        self.assertEqual(track_id, "4uLU6hMCjMI75M1A2tKUQC")
+        self.assertEqual(progress.throttled, 1)
+
+    def test_retries_a_timeout(self):
+        StubSpotify.responses = [(200, {}, 1.0)]
+        track_id, _ = self.track_id(timeout=0.2)
+        self.assertEqual(track_id, "4uLU6hMCjMI75M1A2tKUQC")
+        self.assertEqual(StubSpotify.requests, 2)
+
+    def test_gives_up_after_max_retries(self):
+        StubSpotify.responses = [(429, {"Retry-After": "0"}, 0)] * 3
+        with self.assertRaises(LookupFailed):
+            self.track_id(max_retries=2)
+        self.assertEqual(StubSpotify.requests, 3)
+
+    def enrich(self, cache, **options):
+        async def run():
+            enricher = SpotifyEnricher(
+                "token", base_url=self.base_url, rate=100, cache=cache,
+                **options
+            )
+            return await enricher.enrich_rows([("Artist", "Track", None)])
+
+        return asyncio.run(run())
+
+    def test_failed_search_is_not_cached(self):
+        StubSpotify.responses = [(503, {}, 0)]
+        with tempfile.TemporaryDirectory() as directory:
+            with EnrichmentCache(Path(directory) / "cache.db") as cache:
+                self.assertEqual(self.enrich(cache, max_retries=0), [None])
+                self.assertIsNone(cache.get("Artist", "Track"))
+
+    def test_empty_search_is_cached_as_a_miss(self):
+        StubSpotify.result = {"tracks": {"items": []}}
+        with tempfile.TemporaryDirectory() as directory:
+            with EnrichmentCache(Path(directory) / "cache.db") as cache:
+                [row] = self.enrich(cache)
+                self.assertEqual(row["trackID"], id_not_found)
+                self.assertEqual(cache.get("Artist", "Track"), (None, None))
+
+
+class PendingTracksTest(unittest.TestCase):
+    def test_expired_misses_are_pending_again(self):
+        history = pd.DataFrame(
+            {"artistName": ["A", "B", "C"], "trackName": ["1", "2", "3"]}
+        )
+        dictionary = pd.DataFrame(
+            {
+                "artistName": ["A", "B"],
+                "trackName": ["1", "2"],
+                "trackID": ["4uLU6hMCjMI75M1A2tKUQC", id_not_found],
+            }
+        )
+        self.assertEqual(pending_tracks(history, dictionary), [("C", "3")])
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "cache.db"
+            with EnrichmentCache(path) as cache:
+                cache.put("B", "2", None, None)
+                self.assertEqual(
+                    pending_tracks(history, dictionary, cache), [("C", "3")]
+                )
+            with EnrichmentCache(path, negative_ttl=-1) as cache:
+                self.assertEqual(
+                    pending_tracks(history, dictionary, cache),
+                    [("B", "2"), ("C", "3")],
+                )
+
+
+class RetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(retry_after_seconds("3"), 3.0)
+
+    def test_http_date(self):
+        retry_after = formatdate(time.time() + 30, usegmt=True)
+        self.assertAlmostEqual(retry_after_seconds(retry_after), 30, delta=2)
+
+    def test_missing_or_invalid(self):
+        self.assertEqual(retry_after_seconds(None), 1.0)
+        self.assertEqual(retry_after_seconds("soon"), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from export_reader import normalize_extended, read_batches  # noqa: E402
+from history_store import HistoryAppender  # noqa: E402
+
+
+def track(uri="spotify:track:4uLU6hMCjMI75M1A2tKUQC", **fields):
+    record = {
+        "ts": "2023-05-01T10:00:30Z",
+        "master_metadata_album_artist_name": "Artist",
+        "master_metadata_track_name": "Track",
+        "ms_played": 200000,
+        "spotify_track_uri": uri,
+    }
+    record.update(fields)
+    return record
+
+
+def episode():
+    return {
+        "ts": "2023-05-01T11:00:00Z",
+        "master_metadata_track_name": None,
+        "ms_played": 600000,
+        "spotify_track_uri": None,
+        "spotify_episode_uri": "spotify:episode:0a1b2c",
+    }
+
+
+class NormalizeExtendedTest(unittest.TestCase):
+    def test_track(self):
+        df = normalize_extended([track()])
+        self.assertEqual(df["trackID"].tolist(), ["4uLU6hMCjMI75M1A2tKUQC"])
+        self.assertEqual(str(df["endTime"][0]), "2023-05-01 10:00:00")
+
+    def test_all_podcast_batch(self):
+        df = normalize_extended([episode(), episode()])
+        self.assertTrue(df.empty)
+        self.assertIn("trackID", df.columns)
+
+    def test_null_uri_batch(self):
+        # Local files are tracks without a Spotify URI
+        df = normalize_extended([track(uri=None), track(uri=None)])
+        self.assertEqual(len(df), 2)
+        self.assertTrue(df["trackID"].isna().all())
+
+    def test_records_without_uri_key(self):
+        record = track()
+        del record["spotify_track_uri"]
+        df = normalize_extended([record])
+        self.assertTrue(df["trackID"].isna().all())
+
+
+class ReadBatchesTest(unittest.TestCase):
+    def test_podcasts_in_the_last_batch_are_appended_as_nothing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            export = directory / "Streaming_History_Audio_2023.json"
+            export.write_text(json.dumps([track(), episode(), episode()]))
+            csv_path = directory / "streaming_history.csv"
+            csv_path.write_text(
+                "endTime,artistName,trackName,msPlayed,trackID\n"
+            )
+            batches = list(read_batches(export, batch_size=2))
+            self.assertEqual([len(batch) for batch in batches], [1, 0])
+            with HistoryAppender(csv_path) as appender:
+                appended = sum(
+                    len(appender.append(batch)) for batch in batches
+                )
+            self.assertEqual(appended, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import history_store  # noqa: E402
+from history_store import (  # noqa: E402
+    HistoryAppender,
+    load_streaming_history,
+    read_json,
+    store_dir,
+)
+
+
+def plays(start, n):
+    return pd.DataFrame(
+        {
+            "endTime": pd.date_range(start, periods=n, freq="min").strftime(
+                "%Y-%m-%d %H:%M"
+            ),
+            "artistName": "Artist",
+            "trackName": [f"Track {i}" for i in range(n)],
+            "msPlayed": 200000,
+            "trackID": None,
+        }
+    )
+
+
+class CompactTest(unittest.TestCase):
+    def test_parts_are_merged_into_a_new_base(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = Path(directory) / "streaming_history.csv"
+            plays("2023-01-01", 3).to_csv(csv_path, index=False)
+            before = load_streaming_history(csv_path)
+            max_parts = history_store.max_parts
+            history_store.max_parts = 2
+            try:
+                with HistoryAppender(csv_path) as appender:
+                    for day in range(2, 6):
+                        appender.append(plays(f"2023-01-{day:02d}", 2))
+            finally:
+                history_store.max_parts = max_parts
+            meta = read_json(store_dir(csv_path) / "meta.json")
+            self.assertEqual(meta["parts"], [])
+            self.assertNotEqual(meta["base"], "base.parquet")
+            history = load_streaming_history(csv_path)
+            self.assertEqual(len(history), 11)
+            pd.testing.assert_frame_equal(history.iloc[:3], before)
+            stored = store_dir(csv_path).glob("*.parquet")
+            self.assertEqual([p.name for p in stored], [meta["base"]])
+
+
+if __name__ == "__main__":
+    unittest.main()